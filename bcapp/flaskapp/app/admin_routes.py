@@ -1,3 +1,4 @@
+import json
 import datetime
 from flask import render_template, redirect, url_for, request, flash
 from flask_login import login_required, current_user, login_user, logout_user
@@ -9,6 +10,7 @@ from . import db
 from . import admin_utilities
 import repo_utilities
 import mirror_tests
+import log_report_formats
 
 ### Admin
 
@@ -248,6 +250,10 @@ def display_log_report():
         flash('No such report!')
         return redirect(url_for('admin'))
     if current_user.admin or int(current_user.domain_id) == int(log_report.domain_id):
+        if log_report.report_data:
+            report_html = log_report_formats.render_html(json.loads(log_report.report_data))
+            return render_template('log_report.html', log_report=log_report, domain=domain_name, report_html=report_html)
+        # reports saved before report_data was kept
         report_text = log_report.report.split('\n')
         return render_template('log_report.html', log_report=log_report, domain=domain_name, report_text=report_text)
     else:
@@ -113,6 +113,38 @@ class LogReport(db.Model):
     hits = db.Column(db.Numeric)
     report = db.Column(db.String)
     log_type = db.Column(db.String)
+    unique_visitors = db.Column(db.Integer)
+    report_data = db.Column(db.Text)
 
     def __repr__(self):
-        return '<id {}>'.format(self.id)
\ No newline at end of file
+        return '<id {}>'.format(self.id)
+
+class LogHourly(db.Model):
+    __tablename__ = "log_hourly"
+    id = db.Column(db.Integer, primary_key=True)
+    domain_id = db.Column(db.Integer, index=True)
+    source = db.Column(db.String, index=True)
+    hour = db.Column(db.DateTime, index=True)
+    hits = db.Column(db.Integer)
+    status_2xx = db.Column(db.Integer)
+    status_3xx = db.Column(db.Integer)
+    status_4xx = db.Column(db.Integer)
+    status_5xx = db.Column(db.Integer)
+    unique_visitors = db.Column(db.Integer)
+    visitors_hll = db.Column(db.String)
+    top_paths = db.Column(db.String)
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
+
+class ProcessedLog(db.Model):
+    __tablename__ = "processed_logs"
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String, unique=True)
+    etag = db.Column(db.String)
+    size = db.Column(db.BigInteger)
+    log_report_id = db.Column(db.Integer)
+    date_processed = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
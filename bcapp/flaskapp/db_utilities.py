@@ -0,0 +1,51 @@
+"""
+Database access for the command line tools
+
+One engine per process, whose pool keeps connections open between
+queries, and tables reflected once, the first time they are used,
+instead of a new engine, connection and reflection for every query.
+"""
+import os
+import threading
+from dotenv import load_dotenv
+import sqlalchemy as db
+from system_utilities import get_configs
+
+_lock = threading.RLock()
+_engine = None
+_metadata = None
+_pid = None
+
+def get_engine():
+    """
+    The engine for DATABASE_URL (from the environment or .env, else from
+    auto.cfg). A process forked from one that used the database, as
+    log_stats --workers does, gets its own, as connections can't be
+    shared between processes
+    """
+    global _engine, _metadata, _pid
+    with _lock:
+        if _engine is None or _pid != os.getpid():
+            load_dotenv()
+            database_url = os.environ.get('DATABASE_URL') or get_configs()['database_url']
+            _engine = db.create_engine(database_url, pool_pre_ping=True)
+            _metadata = db.MetaData()
+            _pid = os.getpid()
+        return _engine
+
+def get_table(name):
+    """
+    A table, reflected from the database the first time it is asked for
+    """
+    engine = get_engine()
+    with _lock:
+        if name not in _metadata.tables:
+            db.Table(name, _metadata, autoload=True, autoload_with=engine)
+        return _metadata.tables[name]
+
+def connect():
+    """
+    A connection from the pool. Use it in a with block, so it goes back
+    to the pool afterwards
+    """
+    return get_engine().connect()
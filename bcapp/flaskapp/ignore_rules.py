@@ -0,0 +1,82 @@
+"""
+Per-domain rules for paths to leave out of log analysis
+
+The domains table stores comma separated lists of extensions
+(ext_ignore) and paths (paths_ignore). A path is skipped if it contains
+any of them.
+"""
+import re
+import functools
+
+_END = ''
+
+class IgnoreRules(object):
+    """
+    All of a domain's ignore patterns compiled into one regular
+    expression shaped like a trie, so a path is checked in a single
+    pass whose cost doesn't grow with the number of patterns
+    """
+    def __init__(self, patterns):
+        self.patterns = sorted(set(pattern for pattern in patterns if pattern))
+        if self.patterns:
+            self.regex = re.compile(_trie_pattern(_build_trie(self.patterns)))
+            self.search = self.regex.search
+        else:
+            self.regex = None
+            self.search = _no_match
+
+    def should_skip(self, path):
+        """
+        Should this path be left out of the analysis?
+        :arg path
+        :returns True or False
+        """
+        return self.search(path) is not None
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def __repr__(self):
+        return '<IgnoreRules {}>'.format(','.join(self.patterns))
+
+def _no_match(path):
+    return None
+
+def _build_trie(patterns):
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for char in pattern:
+            node = node.setdefault(char, {})
+        node[_END] = True
+    return trie
+
+def _trie_pattern(node):
+    """
+    Regular expression for a trie node. A pattern that ends here
+    already matches, so anything longer that shares its prefix is dropped
+    """
+    if _END in node:
+        return ''
+    branches = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
+
+def split_rules(rules):
+    """
+    Splits a comma separated rules column into its patterns
+    """
+    if not rules:
+        return []
+    return [rule.strip() for rule in rules.split(',') if rule.strip()]
+
+@functools.lru_cache(maxsize=256)
+def compile_ignore_rules(ext_ignore, paths_ignore):
+    """
+    Builds (once per distinct setting) the ignore rules for a domain
+    :arg ext_ignore: ext_ignore column of the domains table
+    :arg paths_ignore: paths_ignore column of the domains table
+    :returns IgnoreRules
+    """
+    return IgnoreRules(split_rules(ext_ignore) + split_rules(paths_ignore))
@@ -0,0 +1,205 @@
+"""
+Log agent for edge hosts: analyzes access logs where they are written,
+and ships only the analysis to the log bucket instead of the raw logs
+
+Each run reads the lines added to the live log files since the last run,
+following files through log rotation, and saves their analysis as an
+artifact (see log_artifacts), which log_stats turns into reports and
+log_rollup merges like any other. Run it from cron, or with --interval
+to keep running.
+
+version 0.1
+"""
+import os
+import time
+import socket
+import datetime
+import fnmatch
+import itertools
+import click
+import logging
+from system_utilities import get_configs, load_state, save_state
+from simple_AWS.s3_functions import *
+from log_reporting_utilities import analyze_lines, LOG_DATE_FORMAT
+from log_parsers import LOG_FORMATS, SNIFF_LINES, detect_log_format
+from log_artifacts import artifact_key, dump_artifact
+from log_keys import KEY_DATE_FORMAT
+
+logger = logging.getLogger('logger')
+
+# Start of the file name part of the keys of agent artifacts
+AGENT_PREFIX = 'agent.'
+
+@click.command()
+@click.option('--daemon', is_flag=True, default=False, help="Run in daemon mode. All output goes to a file.")
+@click.option('--interval', type=int, help="Seconds between runs. Default is to run once")
+@click.option('--pattern', help="Pattern names of live log files match. Default is *access*.log", default='*access*.log')
+@click.option('--log_format', type=click.Choice(sorted(LOG_FORMATS)), help="Format of the logs (default is to detect it)")
+@click.option('--sketch', type=int, help="Keep approximate counts for at most this many pages and user agents")
+@click.option('--bots', is_flag=True, default=False, help="Count bots and crawlers as visitors")
+@click.option('--ext_ignore', help="Comma separated extensions to leave out, as in the domains table")
+@click.option('--paths_ignore', help="Comma separated paths to leave out, as in the domains table")
+
+def agent(daemon, interval, pattern, log_format, sketch, bots, ext_ignore, paths_ignore):
+    configs = get_configs()
+    s3simple = S3Simple(region_name=configs['region'],
+                        profile=configs['profile'],
+                        bucket_name=configs['log_storage_bucket'])
+    # edge hosts don't usually reach the database, so the ignore rules
+    # are given here
+    domain_data = {
+        'id': None,
+        'ext_ignore': ext_ignore,
+        'paths_ignore': paths_ignore
+    }
+    options = {
+        'log_format': LOG_FORMATS[log_format] if log_format else None,
+        'sketch_size': sketch,
+        'count_bots': bots
+    }
+
+    while True:
+        paths = []
+        with open(configs['paths']) as pathfile:
+            for fpath in pathfile.read().split('\n'):
+                if fpath:
+                    paths.append(fpath.split('|'))
+        state = load_state(configs['agent_state'])
+        for (domain, path) in paths:
+            if os.path.isdir(path):
+                try:
+                    files = [entry.path for entry in os.scandir(path)
+                             if entry.is_file() and fnmatch.fnmatch(entry.name, pattern)]
+                except OSError as error:
+                    logger.critical(f"Can't read {path}: {error}")
+                    continue
+            else:
+                files = [path]
+            for file_name in files:
+                # one missing file or failed upload shouldn't stop the rest,
+                # or the next runs; the lines are shipped next time
+                try:
+                    ship_new_lines(s3simple, domain, file_name, state, domain_data, **options)
+                except Exception as error:
+                    logger.critical(f"Couldn't ship {file_name}: {error}")
+                    continue
+                save_state(configs['agent_state'], state)
+        if not interval:
+            break
+        time.sleep(interval)
+
+    return
+
+class LogTail(object):
+    """
+    Complete lines of a file from an offset on. The offset moves past
+    each line as it is read, and a partly written last line is left for
+    next time
+    """
+    def __init__(self, file_name, offset=0):
+        self.file_name = file_name
+        self.offset = offset
+        self.inode = None
+
+    def __iter__(self):
+        with open(self.file_name, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    return
+                self.offset += len(line)
+                yield line.decode(errors='replace')
+
+def ship_new_lines(s3simple, domain, file_name, state, domain_data, log_format=None, sketch_size=None,
+                   count_bots=False):
+    """
+    Analyzes the lines added to a log file since it was last shipped and
+    saves the analysis to the bucket. If the file was rotated, the rest
+    of the old file is read first, wherever it was moved in the same
+    directory
+    :arg state: dict of {'inode', 'offset'} keyed by file name, updated
+    once the analysis is saved
+    :returns True if anything was shipped
+    """
+    stat = os.stat(file_name)
+    shipped = state.get(file_name)
+    sources = []
+    if shipped and shipped['inode'] != stat.st_ino:
+        rotated = find_inode(os.path.dirname(file_name), shipped['inode'])
+        if rotated:
+            logger.debug(f"{file_name} was rotated to {rotated}")
+            sources.append(LogTail(rotated, shipped['offset']))
+        else:
+            logger.warning(f"{file_name} was rotated and the old file is gone, some lines weren't shipped")
+        current = LogTail(file_name)
+    elif shipped and stat.st_size >= shipped['offset']:
+        current = LogTail(file_name, shipped['offset'])
+    else:
+        if shipped:
+            # copytruncate rotation: the lines written since the last run
+            # went into a copy, with a new inode, that can't be told apart
+            # from the older rotated files
+            logger.warning(f"{file_name} was truncated in place, lines written since the last run weren't shipped")
+        current = LogTail(file_name)
+    sources.append(current)
+    # the same lines always get the same key, so shipping them again
+    # after a failure replaces what was saved
+    start = sources[0].offset
+
+    lines = itertools.chain.from_iterable(sources)
+    if log_format is None:
+        head = list(itertools.islice(lines, SNIFF_LINES))
+        log_format = detect_log_format(head)
+        if log_format is None:
+            if head:
+                logger.warning(f"Log format of {file_name} not recognized")
+            return False
+        lines = itertools.chain(head, lines)
+    analyzed_data = analyze_lines(lines, domain_data, log_format=log_format, sketch_size=sketch_size,
+                                  count_bots=count_bots)
+    if not analyzed_data:
+        # too few new lines; they are read again next time
+        return False
+
+    now_string = datetime.datetime.now().strftime(KEY_DATE_FORMAT)
+    earliest = datetime.datetime.strptime(analyzed_data['earliest_date'], LOG_DATE_FORMAT)
+    host = socket.gethostname()
+    name = '.'.join([host] + file_name.split('/') + [str(sources[0].inode), str(start)])
+    key = artifact_key(domain, earliest.strftime(KEY_DATE_FORMAT), AGENT_PREFIX + name.replace('_', '-'))
+    body = dump_artifact(analyzed_data, domain=domain, log_type=analyzed_data['log_type'],
+                         source=f"agent:{host}:{file_name}", analyzed=now_string)
+    s3simple.bucket.put_object(Key=key, Body=body)
+    logger.info(f"Shipped {analyzed_data['hits']} lines of {file_name} ({len(body)} bytes) to {key}")
+
+    state[file_name] = {'inode': current.inode, 'offset': current.offset}
+    return True
+
+def find_inode(directory, inode):
+    """
+    File in a directory with this inode, if there is one
+    """
+    for entry in os.scandir(directory):
+        if entry.inode() == inode and entry.is_file():
+            return entry.path
+    return None
+
+if __name__ == '__main__':
+    configs = get_configs()
+    log = configs['log_level']
+    logger = logging.getLogger('logger')  # instantiate clogger
+    logger.setLevel(logging.DEBUG)  # pass DEBUG and higher values to handler
+
+    ch = logging.StreamHandler()  # use StreamHandler, which prints to stdout
+    ch.setLevel(configs['log_level'])  # ch handler uses the configura
+
+    # create formatter
+    # display the function name and logging level in columnar format if
+    # logging mode is 'DEBUG'
+    formatter = logging.Formatter('[%(funcName)24s] [%(levelname)8s] %(message)s')
+
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    agent()
@@ -0,0 +1,190 @@
+"""
+Reading and writing the LogAnalysis artifacts log_stats saves to the
+log bucket, one per raw log file
+
+Artifacts are gzip compressed JSON with a schema version, so they can
+be loaded without eval and merged later (see log_rollup.py)
+
+Version 1: {'version', 'domain', 'log_type', 'source', 'analyzed', 'analysis'},
+where analysis is from analysis_to_dict. The first JSON artifacts had
+no 'version' and weren't compressed, but are otherwise the same
+Version 0: str() of the analyzed log data, written before there was a
+schema. Only plain counters, so it can be read but not merged
+"""
+import ast
+import gzip
+import json
+import datetime
+import logging
+from log_sketches import SpaceSaving, HyperLogLog
+from log_reporting_utilities import COUNTER_FIELDS, VISITOR_IP_SUMMARY
+from log_keys import partitioned_key, partitioned_objects, key_name, ARTIFACT_KIND, KEY_DATE_FORMAT
+
+logger = logging.getLogger('logger')
+
+ARTIFACT_VERSION = 1
+ARTIFACT_PREFIX = ARTIFACT_KIND + '_'
+ARTIFACT_EXTENSION = '.json.gz'
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+def artifact_key(domain, raw_date, raw_name):
+    """
+    Key of the artifact for a raw log file. It is named after the raw
+    file, so analyzing that file again replaces it
+    :arg domain
+    :arg raw_date: date part of the raw log file key
+    :arg raw_name: file name part of the raw log file key
+    """
+    return partitioned_key(ARTIFACT_KIND, domain, datetime.datetime.strptime(raw_date, KEY_DATE_FORMAT),
+                           ARTIFACT_PREFIX + domain + '_' + raw_date + '_' + raw_name + ARTIFACT_EXTENSION)
+
+def dump_artifact(analyzed_log_data, **kwargs):
+    """
+    Encodes an artifact
+    :arg analyzed_log_data: from analyze_lines
+    :kwargs: domain, log_type, source (raw log file key) and analyzed (date)
+    :returns bytes
+    """
+    artifact = {
+        'version': ARTIFACT_VERSION,
+        'domain': kwargs['domain'],
+        'log_type': kwargs['log_type'],
+        'source': kwargs['source'],
+        'analyzed': kwargs['analyzed'],
+        'analysis': analysis_to_dict(analyzed_log_data)
+    }
+    encoded = json.dumps(artifact, separators=(',', ':')).encode('utf-8')
+    return gzip.compress(encoded, compresslevel=6)
+
+def load_artifact(body):
+    """
+    Decodes an artifact of any version
+    :arg body: bytes, as stored
+    :returns dict with 'version' and 'analysis' (analyzed log data, as
+    from analyze_lines), plus the other fields of version 1 artifacts
+    :raises ValueError if the artifact can't be read
+    """
+    if body[:2] == _GZIP_MAGIC:
+        body = gzip.decompress(body)
+    text = body.decode('utf-8')
+    try:
+        artifact = json.loads(text)
+    except ValueError:
+        try:
+            # Only literals, so a stored file can't run code
+            analysis = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            raise ValueError("Unreadable analysis artifact")
+        return {'version': 0, 'analysis': analysis}
+    version = artifact.get('version', 1)
+    if version > ARTIFACT_VERSION:
+        raise ValueError(f"Analysis artifact version {version} is newer than {ARTIFACT_VERSION}")
+    artifact['version'] = version
+    artifact['analysis'] = analysis_from_dict(artifact['analysis'])
+    return artifact
+
+def analysis_to_dict(analyzed_log_data):
+    """
+    Converts analyzed log data to JSON-compatible types: sketches become
+    dicts (SpaceSaving) or encoded strings (HyperLogLog), and hours are
+    keyed by ISO timestamps
+    :arg: analyzed_log_data - from analyze_lines
+    :returns: dict
+    """
+    converted = {
+        'hits': analyzed_log_data['hits'],
+        'bot_hits': analyzed_log_data['bot_hits'],
+        'user_agent_class': analyzed_log_data['user_agent_class'],
+        'earliest_date': analyzed_log_data['earliest_date'],
+        'latest_date': analyzed_log_data['latest_date'],
+        'status': analyzed_log_data['status'],
+        'unique_visitors': analyzed_log_data['unique_visitors'],
+        'visitor_hll': analyzed_log_data['visitor_hll'].encode(),
+        'daily_visitors': {day: visitors.encode() for (day, visitors) in analyzed_log_data['daily_visitors'].items()},
+        'hourly': {},
+        'sketches': {}
+    }
+    for field in COUNTER_FIELDS:
+        counter = analyzed_log_data[field]
+        if isinstance(counter, SpaceSaving):
+            converted['sketches'][field] = counter.to_dict()
+        else:
+            converted[field] = counter
+    for (start, hour) in analyzed_log_data['hourly'].items():
+        converted['hourly'][start.isoformat()] = {
+            'hits': hour['hits'],
+            'status': hour['status'],
+            'visitors': hour['visitors'].encode(),
+            'top_paths': hour['top_paths']
+        }
+    return converted
+
+def analysis_from_dict(converted):
+    """
+    Rebuilds analyzed log data from analysis_to_dict (after a trip
+    through JSON, which turns status codes into strings)
+    :arg: converted - dict
+    :returns: analyzed log data, as from analyze_lines
+    """
+    analyzed_log_data = {
+        'hits': converted['hits'],
+        # not in artifacts saved before user agents were classified
+        'bot_hits': converted.get('bot_hits', 0),
+        'user_agent_class': dict(converted.get('user_agent_class', {})),
+        'earliest_date': converted['earliest_date'],
+        'latest_date': converted['latest_date'],
+        'status': {int(code): number for (code, number) in converted['status'].items()},
+        'visitor_hll': HyperLogLog.decode(converted['visitor_hll']),
+        'daily_visitors': {day: HyperLogLog.decode(visitors) for (day, visitors) in converted['daily_visitors'].items()},
+        'hourly': {}
+    }
+    analyzed_log_data['unique_visitors'] = converted.get('unique_visitors', analyzed_log_data['visitor_hll'].count())
+    for field in COUNTER_FIELDS:
+        if field in converted.get('sketches', {}):
+            analyzed_log_data[field] = SpaceSaving.from_dict(converted['sketches'][field])
+        else:
+            analyzed_log_data[field] = dict(converted.get(field, {}))
+    if not isinstance(analyzed_log_data['visitor_ips'], SpaceSaving):
+        # artifacts saved before visitor IPs were summarized hold every IP
+        visitor_ips = SpaceSaving(VISITOR_IP_SUMMARY)
+        for (ip, number) in analyzed_log_data['visitor_ips'].items():
+            visitor_ips.add(ip, number)
+        analyzed_log_data['visitor_ips'] = visitor_ips
+    for (start, hour) in converted['hourly'].items():
+        analyzed_log_data['hourly'][datetime.datetime.fromisoformat(start)] = {
+            'hits': hour['hits'],
+            'status': dict(hour['status']),
+            'visitors': HyperLogLog.decode(hour['visitors']),
+            'top_paths': [tuple(path) for path in hour['top_paths']]
+        }
+    return analyzed_log_data
+
+def stored_analyses(s3simple, domain=None, since=None):
+    """
+    Reads the artifacts log_stats saved to the bucket that can be merged
+    :arg: s3simple - S3Simple for the bucket
+    :arg: domain - only this domain's artifacts, default all
+    :arg: since - datetime; skips artifacts of raw log files dated
+    before it, which can only hold older traffic
+    :yields: artifact dicts (see load_artifact), with the key added
+    """
+    for s3_object in partitioned_objects(s3simple, ARTIFACT_KIND, domain, since):
+        try:
+            (artifact_prefix, artifact_domain, raw_date, raw_name) = key_name(s3_object.key).split('_')
+            file_date = datetime.datetime.strptime(raw_date, KEY_DATE_FORMAT)
+        except ValueError:
+            # keys of version 0 artifacts start with the local file path
+            logger.debug(f"Skipping analysis file {s3_object.key}")
+            continue
+        if since and file_date < since:
+            continue
+        try:
+            artifact = load_artifact(s3_object.get()['Body'].read())
+        except ValueError as error:
+            logger.warning(f"Skipping analysis file {s3_object.key}: {error}")
+            continue
+        if artifact['version'] < 1:
+            continue
+        artifact['key'] = s3_object.key
+        yield artifact
@@ -0,0 +1,189 @@
+"""
+Benchmark of the log analysis path on synthetic access logs
+
+Generates a reproducible nginx or EOTK log, then times analyze_lines
+and output on it and measures their peak memory. Runs offline (no S3,
+database or configuration file), so numbers can be compared between
+commits on the same machine.
+
+version 0.1
+"""
+import os
+import bz2
+import gzip
+import json
+import time
+import random
+import datetime
+import tempfile
+import tracemalloc
+import click
+from log_parsers import LOG_FORMATS
+from log_reporting_utilities import analyze_lines, output, open_log_file
+
+# Ignore rules applied while benchmarking, as stored in the domains table
+BENCH_DOMAIN_DATA = {
+    'id': 0,
+    'ext_ignore': '.css,.js,.png,.jpg,.ico,.woff',
+    'paths_ignore': '/wp-admin,/wp-login.php,/static/fonts'
+}
+
+# Paths that match BENCH_DOMAIN_DATA
+IGNORED_PATHS = [
+    '/static/app.js',
+    '/static/site.css',
+    '/static/fonts/icons.woff',
+    '/img/logo.png',
+    '/img/header.jpg',
+    '/favicon.ico',
+    '/wp-admin/admin-ajax.php',
+    '/wp-login.php'
+]
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{}.0.4183.102 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; rv:{}.0) Gecko/20100101 Firefox/78.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 13_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/{}.1 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 10; SM-G973F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{}.0.4183.81 Mobile Safari/537.36',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html) v{}',
+    'curl/7.{}.0'
+]
+
+STATUSES = [200] * 40 + [206, 301, 302, 304, 304, 403, 404, 404, 499, 500, 502]
+
+@click.command()
+@click.option('--lines', type=int, default=200000, help="Lines in the generated log. Default is 200000")
+# generate_log only writes combined format lines
+@click.option('--log_format', type=click.Choice(['eotk', 'nginx']), default='nginx', help="Log format to generate. Default is nginx")
+@click.option('--paths', type=int, default=5000, help="Number of distinct pages. Default is 5000")
+@click.option('--agents', type=int, default=300, help="Number of distinct user agents. Default is 300")
+@click.option('--ips', type=int, default=20000, help="Number of distinct visitor IPs (nginx only). Default is 20000")
+@click.option('--ignored', type=float, default=0.3, help="Share of hits on ignored assets and paths. Default is 0.3")
+@click.option('--compression', type=click.Choice(['none', 'gz', 'bz2']), default='none', help="Compression of the generated log")
+@click.option('--sketch', type=int, help="Sketch size passed to the analysis")
+@click.option('--repeat', type=int, default=3, help="Timed runs; the fastest is reported. Default is 3")
+@click.option('--seed', type=int, default=1, help="Random seed, so runs generate the same log. Default is 1")
+@click.option('--json_output', is_flag=True, default=False, help="Print the results as one line of JSON")
+
+def bench(lines, log_format, paths, agents, ips, ignored, compression, sketch, repeat, seed, json_output):
+    (handle, file_name) = tempfile.mkstemp(suffix='.log' if compression == 'none' else '.log.' + compression)
+    os.close(handle)
+    try:
+        generate_log(file_name, lines=lines, log_format=log_format, paths=paths, agents=agents,
+                     ips=ips, ignored=ignored, seed=seed)
+        results = {
+            'lines': lines,
+            'log_format': log_format,
+            'compression': compression,
+            'sketch': sketch,
+            'file_bytes': os.path.getsize(file_name)
+        }
+        results.update(run_benchmark(file_name, LOG_FORMATS[log_format], sketch, repeat))
+    finally:
+        os.remove(file_name)
+
+    if json_output:
+        print(json.dumps(results))
+        return
+    print(f"{lines} {log_format} lines, {compression}, {results['file_bytes'] / 1e6:.1f}MB, sketch {sketch}")
+    print(f"analyze: {results['analyze_seconds']:.3f}s ({results['lines_per_second']:.0f} lines/s), "
+          f"peak memory {results['analyze_peak_mb']:.1f}MB")
+    print(f"output: {results['output_seconds']:.3f}s, peak memory {results['output_peak_mb']:.1f}MB")
+
+    return
+
+def generate_log(file_name, **kwargs):
+    """
+    Writes a synthetic access log. Pages, user agents and IPs are
+    drawn with Zipf-like weights, so a few are very common and most are
+    rare, as on real sites
+    :arg file_name: .log, .log.gz or .log.bz2
+    :kwargs: lines, log_format, paths, agents, ips, ignored, seed
+    """
+    rng = random.Random(kwargs['seed'])
+    sections = ['article', 'news', 'video', 'about']
+    page_list = ['/'] + [f"/{sections[number % len(sections)]}/{number}" for number in range(1, kwargs['paths'])]
+    agent_list = [USER_AGENTS[number % len(USER_AGENTS)].format(60 + number) for number in range(kwargs['agents'])]
+    ip_list = [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+               for number in range(kwargs['ips'])]
+    page_weights = _zipf_weights(len(page_list))
+    agent_weights = _zipf_weights(len(agent_list))
+    ip_weights = _zipf_weights(len(ip_list))
+    eotk = kwargs['log_format'] == 'eotk'
+
+    timestamp = datetime.datetime(2020, 10, 10)
+    step = datetime.timedelta(seconds=86400 / kwargs['lines'])
+    with _open_for_writing(file_name) as f:
+        remaining = kwargs['lines']
+        while remaining:
+            batch = min(remaining, 10000)
+            remaining -= batch
+            batch_pages = rng.choices(page_list, cum_weights=page_weights, k=batch)
+            batch_agents = rng.choices(agent_list, cum_weights=agent_weights, k=batch)
+            batch_ips = rng.choices(ip_list, cum_weights=ip_weights, k=batch)
+            log_lines = []
+            for (page, agent, ip) in zip(batch_pages, batch_agents, batch_ips):
+                timestamp += step
+                if rng.random() < kwargs['ignored']:
+                    page = rng.choice(IGNORED_PATHS)
+                remote = '-' if eotk else ip
+                log_lines.append(f'{remote} - - [{timestamp:%d/%b/%Y:%H:%M:%S} +0000] "GET {page} HTTP/1.1" '
+                                 f'{rng.choice(STATUSES)} {rng.randint(200, 60000)} "-" "{agent}"\n')
+            f.write(''.join(log_lines))
+
+def _zipf_weights(size):
+    """
+    Cumulative weights 1/rank for random.choices
+    """
+    weights = []
+    total = 0.0
+    for rank in range(1, size + 1):
+        total += 1.0 / rank
+        weights.append(total)
+    return weights
+
+def _open_for_writing(file_name):
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'wt')
+    if file_name.endswith('.bz2'):
+        return bz2.open(file_name, 'wt')
+    return open(file_name, 'w')
+
+def run_benchmark(file_name, log_format, sketch, repeat):
+    """
+    Times the analysis of a log file, then measures peak memory in a
+    separate run (tracing allocations slows Python down)
+    :returns dict of timings and memory
+    """
+    analyze_times = []
+    output_times = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        with open_log_file(file_name) as f:
+            analyzed_data = analyze_lines(f, BENCH_DOMAIN_DATA, log_format=log_format, sketch_size=sketch)
+        analyze_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        output(file_name=file_name, data=analyzed_data, percent=5, num=10)
+        output_times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    with open_log_file(file_name) as f:
+        analyzed_data = analyze_lines(f, BENCH_DOMAIN_DATA, log_format=log_format, sketch_size=sketch)
+    analyze_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    held = tracemalloc.get_traced_memory()[0]
+    output(file_name=file_name, data=analyzed_data, percent=5, num=10)
+    output_peak = tracemalloc.get_traced_memory()[1] - held
+    tracemalloc.stop()
+
+    lines = analyzed_data['hits'] if analyzed_data else 0
+    return {
+        'analyze_seconds': min(analyze_times),
+        'lines_per_second': lines / min(analyze_times),
+        'analyze_peak_mb': analyze_peak / 1e6,
+        'output_seconds': min(output_times),
+        'output_peak_mb': output_peak / 1e6
+    }
+
+if __name__ == '__main__':
+    bench()
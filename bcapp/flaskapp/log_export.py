@@ -0,0 +1,113 @@
+"""
+Export of parsed access log records as compressed columnar (Parquet)
+files, one per domain and day, so ad-hoc analysis can scan just the
+columns it needs without re-downloading and re-parsing raw logs
+
+Needs pyarrow, which is optional
+"""
+import os
+import logging
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger('logger')
+
+COLUMNS = ['timestamp', 'ip', 'method', 'path', 'status', 'bytes', 'referrer', 'user_agent']
+# Columns with few distinct values relative to rows
+DICTIONARY_COLUMNS = ['method', 'path', 'referrer', 'user_agent']
+
+def _schema():
+    return pyarrow.schema([
+        ('timestamp', pyarrow.timestamp('s')),
+        ('ip', pyarrow.string()),
+        ('method', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('path', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('status', pyarrow.int16()),
+        ('bytes', pyarrow.int64()),
+        ('referrer', pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ('user_agent', pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))
+    ])
+
+class ColumnarExporter(object):
+    """
+    Collects parsed LogRecords and writes them out as Parquet files, one
+    per day of the log. Records are buffered in columns and flushed as a
+    row group every batch_size rows, so memory stays bounded
+    """
+    def __init__(self, file_prefix, batch_size=100000):
+        """
+        :arg file_prefix: path and start of the name of the files to write,
+        the day and '.parquet' are added to it
+        :arg batch_size: rows per row group
+        """
+        if not pyarrow:
+            raise RuntimeError("Columnar export needs the pyarrow package")
+        self.file_prefix = file_prefix
+        self.batch_size = batch_size
+        self.schema = _schema()
+        self.files = {}
+        self._writers = {}
+        self._buffers = {}
+
+    def add(self, record, timestamp):
+        """
+        Adds one parsed log record
+        :arg record: LogRecord
+        :arg timestamp: its decoded datetime
+        """
+        day = timestamp.strftime('%Y-%m-%d')
+        if day not in self._buffers:
+            self._buffers[day] = {column: [] for column in COLUMNS}
+        buffer = self._buffers[day]
+        buffer['timestamp'].append(timestamp)
+        buffer['ip'].append(record.ip)
+        buffer['method'].append(record.method)
+        buffer['path'].append(record.path)
+        buffer['status'].append(record.status)
+        buffer['bytes'].append(record.bytes)
+        buffer['referrer'].append(record.referrer)
+        buffer['user_agent'].append(record.user_agent)
+        if len(buffer['timestamp']) >= self.batch_size:
+            self._flush(day)
+
+    def _flush(self, day):
+        buffer = self._buffers[day]
+        if not buffer['timestamp']:
+            return
+        if day not in self._writers:
+            file_name = f"{self.file_prefix}_{day}.parquet"
+            self.files[day] = file_name
+            self._writers[day] = pyarrow.parquet.ParquetWriter(
+                file_name,
+                self.schema,
+                compression='zstd',
+                use_dictionary=DICTIONARY_COLUMNS
+            )
+        table = pyarrow.Table.from_pydict(buffer, schema=self.schema)
+        self._writers[day].write_table(table)
+        self._buffers[day] = {column: [] for column in COLUMNS}
+
+    def close(self):
+        """
+        Writes out what's left and closes the files
+        :returns: dict of file names written, keyed by day (YYYY-MM-DD)
+        """
+        for day in list(self._buffers):
+            self._flush(day)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+        logger.debug(f"Columnar files written: {self.files}")
+        return self.files
+
+    def discard(self):
+        """
+        Closes and removes the files, for when the analysis is abandoned
+        """
+        for file_name in self.close().values():
+            os.remove(file_name)
+        self.files = {}
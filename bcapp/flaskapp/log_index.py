@@ -0,0 +1,154 @@
+"""
+Local index of the log bucket, kept in SQLite, so the latest raw logs or
+reports of a domain can be found without listing the bucket each time
+
+Objects are indexed by kind, domain and date (see log_keys). A refresh
+only lists the most recent day partitions of the domains asked for, as
+older partitions don't change. The contents of recently read output
+files are kept too, and used for as long as the object's etag doesn't
+change.
+"""
+import os
+import time
+import sqlite3
+import datetime
+import logging
+from log_keys import log_domains, partitioned_objects, key_date, PARTITION_DATE_FORMAT
+
+logger = logging.getLogger('logger')
+
+# Days listed again on each refresh. move_logs files raw logs under the
+# day they were last modified, so new files can land in recent days
+REFRESH_DAYS = 8
+# Seconds an index stays fresh enough to use without listing again
+REFRESH_INTERVAL = 300
+# Output files whose contents are kept
+CACHED_CONTENTS = 50
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    day TEXT NOT NULL,
+    date TEXT,
+    size INTEGER,
+    etag TEXT
+);
+CREATE INDEX IF NOT EXISTS objects_by_date ON objects (kind, domain, date);
+CREATE TABLE IF NOT EXISTS refreshes (
+    kind TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    refreshed REAL NOT NULL,
+    PRIMARY KEY (kind, domain)
+);
+CREATE TABLE IF NOT EXISTS contents (
+    key TEXT PRIMARY KEY,
+    etag TEXT,
+    body TEXT,
+    accessed REAL
+);
+"""
+
+class LogIndex(object):
+    """
+    Index of the objects in a log bucket
+    """
+    def __init__(self, file_name, s3simple):
+        """
+        :arg file_name: SQLite database, created if it doesn't exist
+        :arg s3simple: S3Simple for the log bucket
+        """
+        self.s3simple = s3simple
+        self.connection = sqlite3.connect(file_name)
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def refresh(self, kind, domain, full=False):
+        """
+        Brings the index of a kind of object up to date, for the domains
+        named like domain. Skipped if done in the last REFRESH_INTERVAL
+        seconds
+        :arg kind: one of log_keys.KINDS
+        :arg domain: domains containing this are refreshed
+        :arg full: list every partition, not only the recent ones
+        """
+        row = self.connection.execute("SELECT refreshed FROM refreshes WHERE kind = ? AND domain = ?",
+                                      (kind, domain)).fetchone()
+        if row and not full and time.time() - row[0] < REFRESH_INTERVAL:
+            return
+
+        for log_domain in log_domains(self.s3simple, kind):
+            if domain not in log_domain:
+                continue
+            latest = self.connection.execute("SELECT max(day) FROM objects WHERE kind = ? AND domain = ?",
+                                             (kind, log_domain)).fetchone()[0]
+            since = None
+            if latest and not full:
+                since = datetime.datetime.strptime(latest, PARTITION_DATE_FORMAT) - datetime.timedelta(days=REFRESH_DAYS)
+            rows = []
+            for s3_object in partitioned_objects(self.s3simple, kind, log_domain, since):
+                date = key_date(s3_object.key)
+                rows.append((s3_object.key, kind, log_domain, s3_object.key.split('/')[2],
+                             date.isoformat() if date else None, s3_object.size, s3_object.e_tag.strip('"')))
+            logger.debug(f"Indexed {len(rows)} {kind} objects of {log_domain}")
+            with self.connection:
+                # whatever was listed replaces the index of those days, so
+                # deleted objects are dropped
+                if since:
+                    self.connection.execute("DELETE FROM objects WHERE kind = ? AND domain = ? AND day >= ?",
+                                            (kind, log_domain, since.strftime(PARTITION_DATE_FORMAT)))
+                else:
+                    self.connection.execute("DELETE FROM objects WHERE kind = ? AND domain = ?", (kind, log_domain))
+                self.connection.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?)", (kind, domain, time.time()))
+
+    def latest(self, kind, domain, num):
+        """
+        Most recent objects of a kind, for the domains named like domain
+        :returns list of dicts with date (datetime), file_name (key), size
+        and etag, newest first
+        """
+        self.refresh(kind, domain)
+        rows = self.connection.execute(
+            "SELECT date, key, size, etag FROM objects WHERE kind = ? AND instr(domain, ?) > 0 AND date IS NOT NULL "
+            "ORDER BY date DESC LIMIT ?", (kind, domain, num)).fetchall()
+        return [{
+            'date': datetime.datetime.fromisoformat(date),
+            'file_name': key,
+            'size': size,
+            'etag': etag
+        } for (date, key, size, etag) in rows]
+
+    def contents(self, key):
+        """
+        Contents of a text object, from the cache if it hasn't changed
+        since it was last read
+        """
+        indexed = self.connection.execute("SELECT etag FROM objects WHERE key = ?", (key,)).fetchone()
+        cached = self.connection.execute("SELECT etag, body FROM contents WHERE key = ?", (key,)).fetchone()
+        if cached and indexed and cached[0] == indexed[0]:
+            with self.connection:
+                self.connection.execute("UPDATE contents SET accessed = ? WHERE key = ?", (time.time(), key))
+            return cached[1]
+
+        response = self.s3simple.bucket.Object(key).get()
+        with response['Body'] as body:
+            text = body.read().decode(errors='replace')
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?)",
+                                    (key, response['ETag'].strip('"'), text, time.time()))
+            self.connection.execute(
+                "DELETE FROM contents WHERE key NOT IN (SELECT key FROM contents ORDER BY accessed DESC LIMIT ?)",
+                (CACHED_CONTENTS,))
+        return text
+
+def open_log_index(configs, s3simple):
+    """
+    The index of the log bucket, kept in local_tmp
+    """
+    return LogIndex(os.path.join(configs['local_tmp'], 'log_index.sqlite'), s3simple)
@@ -0,0 +1,123 @@
+"""
+Layout of the log bucket
+
+Objects are kept under prefixes for their kind, domain and day:
+
+    RawLogFile/example.com/2020-10-10/RawLogFile_example.com_10-Oct-2020:12:00:00_access.log
+
+so finding a domain's recent files lists only those, however many other
+files the bucket holds. The last part is the flat name used before
+partitioning, which the rest of the code still parses.
+(migrate_log_keys.py moves objects with flat keys into this layout.)
+"""
+import re
+import datetime
+
+RAW_LOG_KIND = 'RawLogFile'
+OUTPUT_KIND = 'LogAnalysisOutput'
+ARTIFACT_KIND = 'LogAnalysis'
+ROLLUP_KIND = 'LogRollup'
+PARSED_LOG_KIND = 'ParsedLogs'
+KINDS = [RAW_LOG_KIND, OUTPUT_KIND, ARTIFACT_KIND, ROLLUP_KIND, PARSED_LOG_KIND]
+
+KEY_DATE_FORMAT = '%d-%b-%Y:%H:%M:%S'
+PARTITION_DATE_FORMAT = '%Y-%m-%d'
+_KEY_DATE = re.compile(r'[0-9]{2}-[a-zA-Z]{3}-20[0-9]{2}:[0-9]{2}:[0-9]{2}:[0-9]{2}')
+
+def partitioned_key(kind, domain, date, name):
+    """
+    Key of an object in the bucket
+    :arg kind: one of KINDS
+    :arg domain
+    :arg date: datetime (or date) the object is filed under
+    :arg name: flat name of the object
+    """
+    return kind + '/' + domain + '/' + date.strftime(PARTITION_DATE_FORMAT) + '/' + name
+
+def key_name(key):
+    """
+    Flat name of an object, with the partition prefixes taken off
+    """
+    return key.rsplit('/', 1)[-1]
+
+def key_date(key):
+    """
+    Date and time in a flat name, as written by move_logs and log_stats
+    :returns datetime, or None if there isn't one
+    """
+    match = _KEY_DATE.search(key_name(key))
+    if not match:
+        return None
+    return datetime.datetime.strptime(match.group(0), KEY_DATE_FORMAT)
+
+def log_domains(s3simple, kind):
+    """
+    Domains with objects of a kind, from the partition prefixes, without
+    listing the objects themselves
+    :arg s3simple: S3Simple for the bucket
+    :arg kind: one of KINDS
+    :returns list of domains
+    """
+    paginator = s3simple.s3.meta.client.get_paginator('list_objects_v2')
+    domains = []
+    for page in paginator.paginate(Bucket=s3simple.bucket.name, Prefix=kind + '/', Delimiter='/'):
+        for common_prefix in page.get('CommonPrefixes', []):
+            domains.append(common_prefix['Prefix'].split('/')[1])
+    return domains
+
+def partitioned_objects(s3simple, kind, domain=None, since=None):
+    """
+    Objects of a kind, listing only the partitions asked for
+    :arg s3simple: S3Simple for the bucket
+    :arg kind: one of KINDS
+    :arg domain: a domain, or a list of them; default all domains
+    :arg since: datetime; only objects filed on or after its day
+    :yields boto3 ObjectSummary
+    """
+    if domain is None:
+        domains = log_domains(s3simple, kind)
+    elif isinstance(domain, str):
+        domains = [domain]
+    else:
+        domains = domain
+    for listed_domain in domains:
+        prefix = kind + '/' + listed_domain + '/'
+        if since:
+            # keys are listed in order, and day partitions sort by date
+            objects = s3simple.bucket.objects.filter(Prefix=prefix, Marker=prefix + since.strftime(PARTITION_DATE_FORMAT))
+        else:
+            objects = s3simple.bucket.objects.filter(Prefix=prefix)
+        for s3_object in objects:
+            yield s3_object
+
+def flat_key_partition(key):
+    """
+    Where an object with a flat key (from before partitioning) belongs
+    :arg key
+    :returns partitioned key, or None if the key isn't a flat key of a
+    known kind or has no date
+    """
+    if '/' in key:
+        return None
+    parts = key.split('_')
+    if len(parts) < 3 or parts[0] not in KINDS:
+        return None
+    (kind, domain) = (parts[0], parts[1])
+    if kind == ARTIFACT_KIND and domain.endswith(RAW_LOG_KIND):
+        # the first artifacts were named after the local copy of the raw
+        # file, LogAnalysis_.tmp.RawLogFile_<domain>_<date>_<name>_<date>.json,
+        # and are filed with it
+        if len(parts) < 4:
+            return None
+        domain = parts[2]
+    if kind == PARSED_LOG_KIND:
+        # filed under the day of the traffic, as log_stats does
+        try:
+            date = datetime.datetime.strptime(parts[2], PARTITION_DATE_FORMAT)
+        except ValueError:
+            return None
+    else:
+        date = key_date(key)
+        if not date:
+            return None
+    return partitioned_key(kind, domain, date, key)
@@ -0,0 +1,337 @@
+"""
+Parsers for the access log formats we analyze
+
+Each format tokenizes a line once, with a single compiled regular
+expression (or one json.loads), into a LogRecord of typed fields.
+detect_log_format picks the format of a log from its first lines.
+"""
+import re
+import json
+import datetime
+import functools
+import collections
+import urllib.parse
+
+LogRecord = collections.namedtuple('LogRecord', [
+    'ip',
+    'timestamp',
+    'method',
+    'path',
+    'status',
+    'bytes',
+    'referrer',
+    'user_agent'
+])
+
+# Pieces of the nginx "combined" layout:
+# $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent"
+_TIME_LOCAL = r'\[(\d{2}/[A-Za-z]{3}/\d{4}:\d{2}:\d{2}:\d{2})[^\]]*\]'
+_REQUEST = r'"(?:(\S+) (\S+)[^"]*|[^"]*)"'
+_STATUS_BYTES = r'(\d{3}) (\d+|-)'
+_QUOTED = r'"([^"]*)"'
+
+@functools.lru_cache(maxsize=4096)
+def _decode_minute(minute):
+    return datetime.datetime.strptime(minute, '%d/%b/%Y:%H:%M')
+
+def decode_time_local(timestamp):
+    """
+    Decodes an nginx $time_local timestamp (10/Oct/2000:13:55:36)
+    Busy logs repeat the same minute many times, so only the minute
+    prefix goes through strptime, and that result is cached
+    :arg timestamp
+    :returns datetime
+    """
+    return _decode_minute(timestamp[:17]).replace(second=int(timestamp[18:20]))
+
+@functools.lru_cache(maxsize=4096)
+def _decode_iso_minute(minute):
+    return datetime.datetime.strptime(minute, '%Y-%m-%dT%H:%M')
+
+# Start of the ISO 8601 timestamps decode_iso_time reads
+_ISO_TIMESTAMP = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}')
+
+def decode_iso_time(timestamp):
+    """
+    Decodes an ISO 8601 timestamp (2000-10-10T13:55:36Z), ignoring
+    fractions of a second and the time zone, the same way as
+    decode_time_local
+    :arg timestamp
+    :returns datetime
+    """
+    return _decode_iso_minute(timestamp[:16]).replace(second=int(timestamp[17:19]))
+
+class TimestampRange(object):
+    """
+    Running earliest and latest timestamps of a log
+    """
+    def __init__(self, decode=decode_time_local):
+        self.decode = decode
+        self.earliest = None
+        self.latest = None
+        self._last = None
+        self._last_datetime = None
+
+    def add(self, timestamp):
+        """
+        Adds a raw timestamp string - consecutive lines usually share the
+        same second, so repeats are skipped without decoding
+        :returns: the decoded datetime
+        """
+        if timestamp == self._last:
+            return self._last_datetime
+        self._last = timestamp
+        line_datetime = self._last_datetime = self.decode(timestamp)
+        if self.earliest is None:
+            self.earliest = self.latest = line_datetime
+        elif line_datetime < self.earliest:
+            self.earliest = line_datetime
+        elif line_datetime > self.latest:
+            self.latest = line_datetime
+        return line_datetime
+
+class LogFormat(object):
+    """
+    An access log layout
+    """
+    def __init__(self, name, pattern, has_ips=True, decode_timestamp=decode_time_local, hour_prefix=14,
+                 sniff_pattern=None):
+        """
+        :arg name: also the log type of reports
+        :arg pattern: regular expression of a line
+        :arg has_ips: whether lines have a visitor address
+        :arg decode_timestamp: turns the timestamp of a LogRecord into a datetime
+        :arg hour_prefix: length of the part of a timestamp that identifies its hour
+        :arg sniff_pattern: regular expression only lines of this format
+        match, if pattern would match other formats too
+        """
+        self.name = name
+        self.has_ips = has_ips
+        self.decode_timestamp = decode_timestamp
+        self.hour_prefix = hour_prefix
+        self.regex = re.compile(pattern)
+        self._match = self.regex.match
+        if sniff_pattern:
+            self._sniff = re.compile(sniff_pattern).match
+        else:
+            self._sniff = self._match
+
+    def sniff(self, line):
+        """
+        Could this line be from a log in this format?
+        """
+        return self._sniff(line) is not None
+
+    def parse(self, line):
+        """
+        Tokenizes one log line
+        :arg line
+        :returns LogRecord, or None if the line isn't in this format
+        """
+        match = self._match(line)
+        if not match:
+            return None
+        if self.has_ips:
+            (ip, timestamp, method, path, status, size, referrer, user_agent) = match.groups()
+        else:
+            ip = None
+            (timestamp, method, path, status, size, referrer, user_agent) = match.groups()
+        return LogRecord(
+            ip,
+            timestamp,
+            method,
+            path,
+            int(status),
+            None if size == '-' else int(size),
+            None if referrer == '-' else referrer,
+            user_agent
+        )
+
+    def __repr__(self):
+        return '<LogFormat {}>'.format(self.name)
+
+class CloudFrontLogFormat(LogFormat):
+    """
+    Amazon CloudFront standard logs: tab separated W3C fields, starting
+    date time x-edge-location sc-bytes c-ip cs-method cs(Host)
+    cs-uri-stem sc-status cs(Referer) cs(User-Agent) cs-uri-query.
+    Timestamps are turned into ISO 8601 (2000-10-10T13:55:36)
+    """
+    def __init__(self):
+        super().__init__(
+            'cloudfront',
+            r'(\d{4}-\d{2}-\d{2})\t(\d{2}:\d{2}:\d{2})\t[^\t]*\t(\d+|-)\t([^\t]*)\t([^\t]*)\t[^\t]*\t'
+            r'([^\t]*)\t(\d{3})\t([^\t]*)\t([^\t]*)\t([^\t]*)',
+            decode_timestamp=decode_iso_time,
+            hour_prefix=13
+        )
+
+    def parse(self, line):
+        match = self._match(line)
+        if not match:
+            return None
+        (date, time, size, ip, method, path, status, referrer, user_agent, query) = match.groups()
+        if query != '-':
+            path += '?' + query
+        return LogRecord(
+            ip,
+            date + 'T' + time,
+            method,
+            path,
+            int(status),
+            None if size == '-' else int(size),
+            None if referrer == '-' else referrer,
+            # CloudFront URL encodes spaces and other characters
+            urllib.parse.unquote(user_agent)
+        )
+
+class JSONLogFormat(LogFormat):
+    """
+    Logs with one JSON object per line, as CDNs write them. Anything
+    before the first { on a line (such as a syslog header) is skipped
+    """
+    def __init__(self, name, sniff_pattern, fields, nested=None):
+        """
+        :arg name
+        :arg sniff_pattern: regular expression of lines of this format
+        :arg fields: dict of the key holding each LogRecord field
+        :arg nested: key of an object holding the fields, other than
+        the timestamp
+        """
+        super().__init__(name, sniff_pattern, decode_timestamp=decode_iso_time, hour_prefix=13)
+        self.fields = fields
+        self.nested = nested
+
+    def parse(self, line):
+        if not self._match(line):
+            return None
+        try:
+            data = json.loads(line[line.index('{'):])
+            timestamp = data[self.fields['timestamp']]
+            # epoch numbers and other formats would only fail later,
+            # when the records are analyzed
+            if not isinstance(timestamp, str) or not _ISO_TIMESTAMP.match(timestamp):
+                return None
+            decode_iso_time(timestamp)
+            if self.nested:
+                data = data[self.nested]
+            fields = self.fields
+            status = int(data[fields['status']])
+            size = data.get(fields['bytes'])
+            size = int(size) if size not in (None, '', '-') else None
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+        path = data.get(fields['path'])
+        if path and path.startswith('http'):
+            # full URL, keep the path and query
+            start = path.find('/', path.find('//') + 2)
+            path = path[start:] if start > 0 else '/'
+        referrer = data.get(fields['referrer'])
+        return LogRecord(
+            data.get(fields['ip']) or None,
+            timestamp,
+            data.get(fields['method']),
+            path or None,
+            status,
+            size,
+            referrer if referrer not in ('', '-') else None,
+            data.get(fields['user_agent'], '')
+        )
+
+# Standard nginx access logs. The remote address is only kept when it
+# looks like an IPv4 or IPv6 address, and only logs that have one are
+# detected as nginx.
+NGINX_COMBINED = LogFormat(
+    'nginx',
+    r'(?:([0-9A-Fa-f:.]+)|\S+) \S+ \S+ ' + _TIME_LOCAL + ' ' + _REQUEST + ' ' +
+    _STATUS_BYTES + ' ' + _QUOTED + ' ' + _QUOTED,
+    sniff_pattern=r'[0-9A-Fa-f:.]+ \S+ \S+ ' + _TIME_LOCAL + ' ' + _REQUEST + ' ' + _STATUS_BYTES
+)
+
+# EOTK writes the same combined layout, but visitors arrive over Tor, so
+# there is no visitor address to record.
+EOTK = LogFormat(
+    'eotk',
+    r'\S+ \S+ \S+ ' + _TIME_LOCAL + ' ' + _REQUEST + ' ' +
+    _STATUS_BYTES + ' ' + _QUOTED + ' ' + _QUOTED,
+    has_ips=False,
+    sniff_pattern=r'(?![0-9A-Fa-f:.]+ )\S+ \S+ \S+ ' + _TIME_LOCAL + ' ' + _REQUEST + ' ' + _STATUS_BYTES
+)
+
+CLOUDFRONT = CloudFrontLogFormat()
+
+# Fastly real-time log streaming, with a JSON log format such as
+# {"timestamp":"%{strftime({"%Y-%m-%dT%H:%M:%S%z"}, time.start)}V",
+#  "client_ip":"%{req.http.Fastly-Client-IP}V", "request_method":"%m",
+#  "url":"%{json.escape(req.url)}V", "response_status":%>s,
+#  "response_body_size":%B, "request_referer":"%{json.escape(req.http.referer)}V",
+#  "request_user_agent":"%{json.escape(req.http.User-Agent)}V"}
+FASTLY = JSONLogFormat(
+    'fastly',
+    r'[^{]*\{.*"client_ip"',
+    {
+        'ip': 'client_ip',
+        'timestamp': 'timestamp',
+        'method': 'request_method',
+        'path': 'url',
+        'status': 'response_status',
+        'bytes': 'response_body_size',
+        'referrer': 'request_referer',
+        'user_agent': 'request_user_agent'
+    }
+)
+
+# Azure CDN raw logs (AzureCdnAccessLog), as exported to a storage account
+AZURE_CDN = JSONLogFormat(
+    'azure',
+    r'[^{]*\{.*"AzureCdnAccessLog"',
+    {
+        'ip': 'clientIp',
+        'timestamp': 'time',
+        'method': 'httpMethod',
+        'path': 'requestUri',
+        'status': 'httpStatusCode',
+        'bytes': 'responseBytes',
+        'referrer': 'referer',
+        'user_agent': 'userAgent'
+    },
+    nested='properties'
+)
+
+# Formats detect_log_format chooses from, in order of preference
+LOG_FORMATS = {}
+
+# Lines of a log detect_log_format looks at
+SNIFF_LINES = 20
+
+def register_log_format(log_format):
+    """
+    Adds a format for detect_log_format to choose from
+    :arg log_format: LogFormat
+    """
+    LOG_FORMATS[log_format.name] = log_format
+
+register_log_format(NGINX_COMBINED)
+register_log_format(EOTK)
+register_log_format(CLOUDFRONT)
+register_log_format(FASTLY)
+register_log_format(AZURE_CDN)
+
+def detect_log_format(lines):
+    """
+    Picks the format most of the lines are in. Comments and blank
+    lines (such as the header of CloudFront logs) are left out
+    :arg lines: the first lines of a log (SNIFF_LINES is enough)
+    :returns LogFormat, or None if no format matches any line
+    """
+    matches = dict.fromkeys(LOG_FORMATS, 0)
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        for log_format in LOG_FORMATS.values():
+            if log_format.sniff(line):
+                matches[log_format.name] += 1
+    (best, number) = max(matches.items(), key=lambda kv: kv[1], default=(None, 0))
+    if not number:
+        return None
+    return LOG_FORMATS[best]
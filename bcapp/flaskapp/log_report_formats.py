@@ -0,0 +1,190 @@
+"""
+Log reports built once from analyzed log data, then rendered as text
+(as stored in log_reports and the LogAnalysisOutput files), JSON or HTML
+
+Only the rows that make it into the report are sorted: rows below the
+percentage floor are dropped in one pass first, and the top pages are
+picked with a heap. Output is assembled from a list of lines and joined
+once.
+"""
+import json
+import heapq
+import html
+from log_sketches import SpaceSaving
+
+def build_report(analyzed_log_data, file_name, percent, num):
+    """
+    Picks what goes into a report
+    :arg analyzed_log_data: from analyze_lines (or merged analyses)
+    :arg file_name: what was analyzed, for the title
+    :arg percent: floor percentage of hits for IPs, status codes and agents
+    :arg num: number of top pages
+    :returns dict of JSON-compatible types
+    """
+    hits = analyzed_log_data['hits']
+    floor = hits * percent / 100
+    agents = analyzed_log_data['user_agent']
+    pages = analyzed_log_data['pages_visited']
+    agents_approximate = isinstance(agents, SpaceSaving)
+    pages_approximate = isinstance(pages, SpaceSaving)
+
+    report = {
+        'file_name': file_name,
+        'first_date': analyzed_log_data['earliest_date'],
+        'last_date': analyzed_log_data['latest_date'],
+        'hits': hits,
+        'bot_hits': analyzed_log_data.get('bot_hits', 0),
+        'percent': percent,
+        'num': num,
+        'unique_visitors': analyzed_log_data.get('unique_visitors'),
+        'daily_visitors': [],
+        'visitor_ips': _over_floor(analyzed_log_data['visitor_ips'].items(), floor),
+        'status': _over_floor(analyzed_log_data['status'].items(), floor),
+        'user_agent_classes': _over_floor(analyzed_log_data.get('user_agent_class', {}).items(), floor),
+        'user_agents': {
+            'total': len(agents),
+            'approximate': agents_approximate,
+            'top': []
+        },
+        'pages': {
+            'total': len(pages),
+            'approximate': pages_approximate,
+            'top': []
+        }
+    }
+    if report['unique_visitors']:
+        report['daily_visitors'] = [[day, visitors.count()] for (day, visitors)
+                                    in analyzed_log_data['daily_visitors'].items()]
+    for (agent, number) in _over_floor(agents.items(), floor):
+        report['user_agents']['top'].append([agent, number, agents.error(agent) if agents_approximate else None])
+    for (page, number) in heapq.nlargest(num, pages.items(), key=lambda kv: kv[1]):
+        report['pages']['top'].append([page, number, pages.error(page) if pages_approximate else None])
+    return report
+
+def _over_floor(items, floor):
+    """
+    (key, count) pairs with at least floor counts, highest first
+    """
+    kept = [[key, number] for (key, number) in items if number >= floor]
+    kept.sort(key=lambda kv: kv[1], reverse=True)
+    return kept
+
+def render_text(report):
+    """
+    Report as plain text, one item per line
+    """
+    hits = report['hits']
+    lines = [
+        f"Analysis of: {report['file_name']}, from {report['first_date']} to {report['last_date']}:",
+        f"Hits: {hits}"
+    ]
+    if report.get('bot_hits'):
+        lines.append(f"Hits from bots: {report['bot_hits']} ({report['bot_hits'] / hits * 100:.1f}%)")
+    if report['unique_visitors']:
+        lines.append(f"Unique visitors (estimated): {report['unique_visitors']}")
+        for (day, visitors) in report['daily_visitors']:
+            lines.append(f"Unique visitors on {day}: {visitors}")
+
+    lines.append("IP addresses: ")
+    for (ip, number) in report['visitor_ips']:
+        lines.append(f"{ip}: {number / hits * 100:.1f}%")
+
+    lines.append("Status Codes:")
+    for (code, number) in report['status']:
+        lines.append(f"{code}: {number / hits * 100:.1f}%")
+
+    lines.append("User agent classes:")
+    for (name, number) in report.get('user_agent_classes', []):
+        lines.append(f"{name}: {number / hits * 100:.1f}%")
+
+    agents = report['user_agents']
+    if agents['approximate']:
+        lines.append(f"Number of user agents: at least {agents['total']} (approximate)")
+    else:
+        lines.append(f"Number of user agents: {agents['total']}")
+    for (agent, number, error) in agents['top']:
+        if error is None:
+            lines.append(f"User agent {agent}: {number / hits * 100:.1f}%")
+        else:
+            lines.append(f"User agent {agent}: {number / hits * 100:.1f}% (+/- {error / hits * 100:.1f}%)")
+
+    pages = report['pages']
+    if pages['approximate']:
+        lines.append(f"Number of pages visited: at least {pages['total']} (approximate)")
+    else:
+        lines.append(f"Number of pages visited: {pages['total']}")
+    lines.append(f"Top {report['num']} pages:")
+    for (page, number, error) in pages['top']:
+        if error is None:
+            lines.append(f"Page {page}: {number} {number / hits * 100:.1f}%")
+        else:
+            lines.append(f"Page {page}: {number} (+/- {error}) {number / hits * 100:.1f}%")
+
+    lines.append('')
+    return '\n'.join(lines)
+
+def render_json(report):
+    """
+    Report as a JSON document (the dict from build_report)
+    """
+    return json.dumps(report, separators=(',', ':'))
+
+def render_html(report):
+    """
+    Report as an HTML fragment, with everything from the log escaped
+    """
+    hits = report['hits']
+    escape = html.escape
+    parts = [
+        '<div class="log-report">',
+        f"<p>Analysis of: {escape(str(report['file_name']))}, "
+        f"from {escape(report['first_date'])} to {escape(report['last_date'])}</p>",
+        f"<p>Hits: {hits}</p>"
+    ]
+    if report.get('bot_hits'):
+        parts.append(f"<p>Hits from bots: {report['bot_hits']} ({report['bot_hits'] / hits * 100:.1f}%)</p>")
+    if report['unique_visitors']:
+        parts.append(f"<p>Unique visitors (estimated): {report['unique_visitors']}</p>")
+        parts.append(_html_table(['Day', 'Unique visitors'],
+                                 [[day, visitors] for (day, visitors) in report['daily_visitors']]))
+    parts.append('<h3>IP addresses</h3>')
+    parts.append(_html_table(['IP address', '%'],
+                             [[ip, f"{number / hits * 100:.1f}"] for (ip, number) in report['visitor_ips']]))
+    parts.append('<h3>Status codes</h3>')
+    parts.append(_html_table(['Status', '%'],
+                             [[code, f"{number / hits * 100:.1f}"] for (code, number) in report['status']]))
+
+    parts.append('<h3>User agent classes</h3>')
+    parts.append(_html_table(['Class', '%'],
+                             [[name, f"{number / hits * 100:.1f}"] for (name, number) in report.get('user_agent_classes', [])]))
+
+    agents = report['user_agents']
+    parts.append(f"<h3>User agents: {'at least ' if agents['approximate'] else ''}{agents['total']}</h3>")
+    parts.append(_html_table(['User agent', '%', '+/- %'],
+                             [[agent, f"{number / hits * 100:.1f}",
+                               '' if error is None else f"{error / hits * 100:.1f}"]
+                              for (agent, number, error) in agents['top']]))
+
+    pages = report['pages']
+    parts.append(f"<h3>Pages visited: {'at least ' if pages['approximate'] else ''}{pages['total']}</h3>")
+    parts.append(_html_table(['Page', 'Hits', '+/-', '%'],
+                             [[page, number, '' if error is None else error, f"{number / hits * 100:.1f}"]
+                              for (page, number, error) in pages['top']]))
+    parts.append('</div>')
+    return '\n'.join(parts)
+
+def _html_table(headings, rows):
+    escape = html.escape
+    parts = ['<table class="table">', '<tr>']
+    parts.extend(f"<th>{escape(heading)}</th>" for heading in headings)
+    parts.append('</tr>')
+    for row in rows:
+        parts.append('<tr>' + ''.join(f"<td>{escape(str(cell))}</td>" for cell in row) + '</tr>')
+    parts.append('</table>')
+    return ''.join(parts)
+
+RENDERERS = {
+    'text': render_text,
+    'json': render_json,
+    'html': render_html
+}
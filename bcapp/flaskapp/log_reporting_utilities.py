@@ -2,284 +2,441 @@
 Utilities for log reporting
 Used by command line and flask app
 """
-import re
-import os
+import io
+import json
+import heapq
+import itertools
+import contextlib
+import gzip
+import bz2
+import lzma
 import datetime
 import logging
-from dotenv import load_dotenv
 from simple_AWS.s3_functions import *
 import sqlalchemy as db
 from system_utilities import get_configs
+from db_utilities import get_table, connect
+from log_parsers import NGINX_COMBINED, TimestampRange, detect_log_format, SNIFF_LINES
+from ignore_rules import compile_ignore_rules
+from log_sketches import SpaceSaving, HyperLogLog
+from log_report_formats import build_report, RENDERERS
+from ua_classifier import classify_user_agent
+from log_keys import partitioned_objects, RAW_LOG_KIND, OUTPUT_KIND
+from log_index import open_log_index
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger('logger')
 
-def analyze_file(raw_data, domain):
+# Number of paths kept for each hour of traffic
+HOURLY_TOP_PATHS = 5
+
+# Format of earliest_date and latest_date in analyzed log data
+LOG_DATE_FORMAT = '%d/%b/%Y:%H:%M:%S'
+
+# Counters of analyzed log data, each an exact dict or a SpaceSaving summary
+COUNTER_FIELDS = ['visitor_ips', 'user_agent', 'pages_visited']
+# Size of the SpaceSaving summary visitor IPs are counted in when no
+# sketch size is given. It holds every IP with more than 0.1% of the
+# hits, so every one over the report floor; unique visitors come from
+# the HyperLogLogs, so there's no need for a table of every IP
+VISITOR_IP_SUMMARY = 1000
+
+LOG_DECOMPRESSORS = {
+    'gz': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+}
+if zstandard:
+    LOG_DECOMPRESSORS['zst'] = zstandard.open
+
+def open_log_file(file_name, fileobj=None):
+    """
+    Opens a log file as a stream of text lines, decompressing
+    gzip, bz2, xz and (if zstandard is installed) zst files on the fly
+    :arg: file_name - path of the file, or only its name if fileobj is given
+    :arg: fileobj - binary file object to read instead, such as the
+    body of an S3 object
+    :returns: text file object
+    """
+    ext = file_name.split('.')[-1]
+    if ext in LOG_DECOMPRESSORS:
+        return LOG_DECOMPRESSORS[ext](file_name if fileobj is None else fileobj, 'rt', errors='replace')
+    if fileobj is None:
+        return open(file_name, errors='replace')
+    return io.TextIOWrapper(io.BufferedReader(fileobj), errors='replace')
+
+@contextlib.contextmanager
+def open_s3_log(s3simple, key):
+    """
+    Streams a log file from S3 as text lines, decompressing it on the
+    fly, without saving it locally first
+    :arg: s3simple - S3Simple for the bucket
+    :arg: key
+    :yields: text file object
+    """
+    body = s3simple.bucket.Object(key).get()['Body']
+    try:
+        with open_log_file(key, fileobj=body) as f:
+            yield f
+    finally:
+        body.close()
+
+def analyze_file(raw_data, domain, sketch_size=None, record_sink=None, log_format=None, count_bots=False,
+                 domain_data=None):
     """
     Analyzes the raw data from the file - for status, agents and pages
-    :arg: raw_data
-    :returns: dict of dicts
+    :arg: raw_data - the log contents, either as one string or as any
+    iterable of lines (open file, decompressor stream, S3 body stream)
+    :arg: domain
+    :arg: sketch_size - if set, keep approximate counters for at most
+    this many user agents and pages (see analyze_lines)
+    :arg: record_sink - optional callable given every parsed record and
+    its datetime
+    :arg: log_format - LogFormat of the log, detected from its first
+    lines if not given
+    :arg: count_bots - count bots as visitors (see analyze_lines)
+    :arg: domain_data - from get_domain_data, looked up if not given
+    :returns: dict of dicts, or False if there was too little to analyze
+    or the format wasn't recognized
+    """
+    if domain_data is None:
+        domain_data = get_domain_data(domain)
+
+    if isinstance(raw_data, str):
+        raw_data = io.StringIO(raw_data)
+
+    lines = iter(raw_data)
+    if log_format is None:
+        head = list(itertools.islice(lines, SNIFF_LINES))
+        log_format = detect_log_format(head)
+        if log_format is None:
+            logger.debug("Log format not recognized")
+            return False
+        logger.debug(f"Log format: {log_format.name}")
+        lines = itertools.chain(head, lines)
+
+    return analyze_lines(lines, domain_data, log_format=log_format, sketch_size=sketch_size,
+                         record_sink=record_sink, count_bots=count_bots)
+
+def analyze_lines(lines, domain_data, log_format=NGINX_COMBINED, sketch_size=None, record_sink=None,
+                  count_bots=False):
     """
-    domain_data = get_domain_data(domain)
+    Aggregates log lines one at a time, so memory use is bounded by
+    the size of the counters rather than the size of the log
+    :arg: lines - iterable of log lines
+    :arg: domain_data - dict from get_domain_data
+    :arg: log_format - LogFormat used to parse each line
+    :arg: sketch_size - if set, user agents and pages are counted in
+    SpaceSaving summaries of this size instead of exact dicts, which
+    caps their memory on crawled sites or randomized query strings.
+    Visitor IPs are counted in one of this size or VISITOR_IP_SUMMARY
+    :arg: record_sink - optional callable given every parsed LogRecord and
+    its datetime, including ignored paths (e.g. ColumnarExporter.add)
+    :arg: count_bots - if False, hits from bots and crawlers (see
+    ua_classifier) are left out of visitor IPs, pages and unique visitors.
+    They are still counted in status codes, user agents and 'bot_hits'
+    :returns: dict of dicts, or False if there was too little to analyze
+    The name of the format is kept as 'log_type'. Hits are also counted
+    by class of user agent ('user_agent_class': Chrome, Bot: Googlebot...)
+
+    Traffic is also bucketed by hour ('hourly', keyed by the datetime of
+    the start of the hour): hits, status classes, a HyperLogLog of
+    visitors and the top paths. Unique visitors per day and for the
+    whole file ('daily_visitors', 'visitor_hll') are merged from these.
+    """
+    ignore_rules = compile_ignore_rules(domain_data['ext_ignore'], domain_data['paths_ignore'])
+    should_skip = ignore_rules.search
 
-    if domain_data['paths_ignore']:
-        paths_ignore_list = domain_data['paths_ignore'].split(',')
-    else:
-        paths_ignore_list = False
-    if domain_data['ext_ignore']:
-        exts_ignore_list = domain_data['ext_ignore'].split(',')
-        
-    raw_data_list = raw_data.split('\n')
-    if len(raw_data_list) < 5: # Not worth analyzing
-        return False
     analyzed_log_data = {
-            'visitor_ips': {},
+            'visitor_ips': SpaceSaving(sketch_size or VISITOR_IP_SUMMARY),
             'status': {},
             'user_agent': {},
+            'user_agent_class': {},
             'pages_visited' : {}
         }
-    analyzed_log_data['hits'] = len(raw_data_list)
-    log_date_match = re.compile('[0-9]{2}[\/]{1}[A-Za-z]{3}[\/]{1}[0-9]{4}[:]{1}[0-9]{2}[:]{1}[0-9]{2}[:]{1}[0-9]{2}')
-    log_status_match = re.compile('[\ ]{1}[0-9]{3}[\ ]{1}')
-    log_ip_match = re.compile('[0-9]{1,3}[\.]{1}[0-9]{1,3}[\.]{1}[0-9]{1,3}[\.]{1}[0-9]{1,3}')
-    datetimes = []
-    for line in raw_data_list:
-        has_ips = True
-        log_data = {}
-        line_split = line.split(' ')
-        try:
-            log_data['ip'] = log_ip_match.search(line_split[0]).group(0)
-        except:
-            has_ips = False
-        try:
-            log_data['datetime'] = log_date_match.search(line).group(0)
-            log_data['status'] = log_status_match.search(line).group(0)
-        except:
+    if sketch_size:
+        analyzed_log_data['user_agent'] = SpaceSaving(sketch_size)
+        analyzed_log_data['pages_visited'] = SpaceSaving(sketch_size)
+    visitor_ips = analyzed_log_data['visitor_ips']
+    statuses = analyzed_log_data['status']
+    user_agents = analyzed_log_data['user_agent']
+    pages_visited = analyzed_log_data['pages_visited']
+    hourly = {}
+    hour = None
+    hour_prefix = log_format.hour_prefix
+    add_ip = visitor_ips.add
+    if sketch_size:
+        add_agent = user_agents.add
+        add_page = pages_visited.add
+    parse = log_format.parse
+    dates = TimestampRange(log_format.decode_timestamp)
+    add_date = dates.add
+    agent_classes = analyzed_log_data['user_agent_class']
+    classify = classify_user_agent
+    hits = 0
+    bot_hits = 0
+    for line in lines:
+        hits += 1
+        record = parse(line)
+        if record is None:
             continue
-        datetimes.append(datetime.datetime.strptime(log_data['datetime'], '%d/%b/%Y:%H:%M:%S'))
-        try:
-            log_data['user_agent'] = line.split(' "')[-1]
-        except:
+        line_datetime = add_date(record.timestamp)
+        if record_sink:
+            record_sink(record, line_datetime)
+        if record.timestamp[:hour_prefix] != hour:
+            hour = record.timestamp[:hour_prefix]
+            if hour not in hourly:
+                hourly[hour] = {
+                    'timestamp': record.timestamp,
+                    'hits': 0,
+                    'status': [0] * 10,
+                    'visitors': HyperLogLog(),
+                    'pages': SpaceSaving(HOURLY_TOP_PATHS * 10)
+                }
+            hour_bucket = hourly[hour]
+        hour_bucket['hits'] += 1
+        hour_bucket['status'][record.status // 100] += 1
+        agent_class = classify(record.user_agent)
+        if agent_class.bot:
+            bot_hits += 1
+        human = count_bots or not agent_class.bot
+        if human and record.ip is not None:
+            hour_bucket['visitors'].add(record.ip)
+        page = record.path
+        if page is None:
             continue
-        try:
-            log_data['page_visited'] = line.split(' "')[-3].split(' ')[1]
-        except:
+        if should_skip(page):
             continue
-        if exts_ignore_list:
-            ext_ignore = False
-            for ext in exts_ignore_list:
-                if ext in log_data['page_visited']:
-                    ext_ignore = True
-            if ext_ignore:
-                continue
-        if paths_ignore_list:
-            should_skip = False
-            for ignore in paths_ignore_list:
-                if ignore in log_data['page_visited']:
-                    should_skip = True
-            if should_skip:
-                continue
-        
-        if 'ip' in log_data:
-            if log_data['ip'] in analyzed_log_data['visitor_ips']:
-                analyzed_log_data['visitor_ips'][log_data['ip']] += 1
-            else:
-                analyzed_log_data['visitor_ips'][log_data['ip']] = 1
-        if log_data['status'] in analyzed_log_data['status']:
-            analyzed_log_data['status'][log_data['status']] += 1
+
+        if record.status in statuses:
+            statuses[record.status] += 1
+        else:
+            statuses[record.status] = 1
+        if agent_class.name in agent_classes:
+            agent_classes[agent_class.name] += 1
         else:
-            analyzed_log_data['status'][log_data['status']] = 1
-        if log_data['user_agent'] in analyzed_log_data['user_agent']:
-            analyzed_log_data['user_agent'][log_data['user_agent']] += 1
+            agent_classes[agent_class.name] = 1
+        if sketch_size:
+            add_agent(record.user_agent)
+        elif record.user_agent in user_agents:
+            user_agents[record.user_agent] += 1
         else:
-            analyzed_log_data['user_agent'][log_data['user_agent']] = 1
+            user_agents[record.user_agent] = 1
+        if not human:
+            continue
 
-        if log_data['page_visited'] in analyzed_log_data['pages_visited']:
-            analyzed_log_data['pages_visited'][log_data['page_visited']] += 1
+        hour_bucket['pages'].add(page)
+        if record.ip is not None:
+            add_ip(record.ip)
+        if sketch_size:
+            add_page(page)
+        elif page in pages_visited:
+            pages_visited[page] += 1
         else:
-            analyzed_log_data['pages_visited'][log_data['page_visited']] = 1
+            pages_visited[page] = 1
 
-    datetimes.sort()
-    analyzed_log_data['earliest_date'] = datetimes[0].strftime('%d/%b/%Y:%H:%M:%S')
-    analyzed_log_data['latest_date'] = datetimes[-1].strftime('%d/%b/%Y:%H:%M:%S')
+    if hits < 5 or dates.earliest is None: # Not worth analyzing
+        return False
+    analyzed_log_data['hits'] = hits
+    analyzed_log_data['bot_hits'] = bot_hits
+    analyzed_log_data['log_type'] = log_format.name
+    analyzed_log_data['earliest_date'] = dates.earliest.strftime(LOG_DATE_FORMAT)
+    analyzed_log_data['latest_date'] = dates.latest.strftime(LOG_DATE_FORMAT)
+    analyzed_log_data['hourly'] = {}
+    daily_visitors = {}
+    visitor_hll = HyperLogLog()
+    for hour_bucket in hourly.values():
+        start = log_format.decode_timestamp(hour_bucket['timestamp']).replace(minute=0, second=0)
+        analyzed_log_data['hourly'][start] = {
+            'hits': hour_bucket['hits'],
+            'status': {f"{code}xx": number for (code, number) in enumerate(hour_bucket['status']) if number},
+            'visitors': hour_bucket['visitors'],
+            'top_paths': hour_bucket['pages'].top(HOURLY_TOP_PATHS)
+        }
+        day = start.strftime('%d/%b/%Y')
+        if day not in daily_visitors:
+            daily_visitors[day] = HyperLogLog()
+        daily_visitors[day].merge(hour_bucket['visitors'])
+        visitor_hll.merge(hour_bucket['visitors'])
+    analyzed_log_data['daily_visitors'] = daily_visitors
+    analyzed_log_data['visitor_hll'] = visitor_hll
+    analyzed_log_data['unique_visitors'] = visitor_hll.count()
 
     return(analyzed_log_data)
 
+def merge_analyses(total, other):
+    """
+    Combines two analyses (from analyze_lines, or analysis_from_dict) as
+    if their logs had been analyzed together, so per-file results can be
+    rolled up by day, week or month without the raw logs
+    :arg: total - analyzed log data, updated in place
+    :arg: other - analyzed log data to add to it
+    :returns: total
+    """
+    for field in COUNTER_FIELDS:
+        total[field] = _merge_counter(total[field], other[field])
+    for (code, number) in other['status'].items():
+        total['status'][code] = total['status'].get(code, 0) + number
+    for (name, number) in other['user_agent_class'].items():
+        total['user_agent_class'][name] = total['user_agent_class'].get(name, 0) + number
+    total['hits'] += other['hits']
+    total['bot_hits'] += other['bot_hits']
+    earliest = [datetime.datetime.strptime(analysis['earliest_date'], LOG_DATE_FORMAT) for analysis in (total, other)]
+    latest = [datetime.datetime.strptime(analysis['latest_date'], LOG_DATE_FORMAT) for analysis in (total, other)]
+    total['earliest_date'] = min(earliest).strftime(LOG_DATE_FORMAT)
+    total['latest_date'] = max(latest).strftime(LOG_DATE_FORMAT)
+
+    for (start, other_hour) in other['hourly'].items():
+        if start not in total['hourly']:
+            total['hourly'][start] = {
+                'hits': 0,
+                'status': {},
+                'visitors': HyperLogLog(),
+                'top_paths': []
+            }
+        hour = total['hourly'][start]
+        hour['hits'] += other_hour['hits']
+        for (code, number) in other_hour['status'].items():
+            hour['status'][code] = hour['status'].get(code, 0) + number
+        hour['visitors'].merge(other_hour['visitors'])
+        hour['top_paths'] = _merge_top_paths(hour['top_paths'], other_hour['top_paths'])
+
+    for (day, visitors) in other['daily_visitors'].items():
+        if day in total['daily_visitors']:
+            total['daily_visitors'][day].merge(visitors)
+        else:
+            total['daily_visitors'][day] = HyperLogLog().merge(visitors)
+    total['visitor_hll'].merge(other['visitor_hll'])
+    total['unique_visitors'] = total['visitor_hll'].count()
+    return total
+
+def _merge_counter(total, other):
+    """
+    Adds one counter to another. If either is a SpaceSaving summary the
+    result is one too, as the exact counts are no longer known
+    """
+    if isinstance(total, SpaceSaving):
+        if isinstance(other, SpaceSaving):
+            return total.merge(other)
+        for (key, number) in other.items():
+            total.add(key, number)
+        return total
+    if isinstance(other, SpaceSaving):
+        merged = SpaceSaving(other.capacity).merge(other)
+        for (key, number) in total.items():
+            merged.add(key, number)
+        return merged
+    for (key, number) in other.items():
+        total[key] = total.get(key, 0) + number
+    return total
+
+def _merge_top_paths(top_paths, other_paths):
+    """
+    Combines two hours' top paths lists of (path, count, error). A path
+    missing from a list counts as zero there, so the result may be
+    too low for it, like any top list cut short
+    """
+    counts = {}
+    errors = {}
+    for (path, count, error) in list(top_paths) + list(other_paths):
+        counts[path] = counts.get(path, 0) + count
+        errors[path] = errors.get(path, 0) + error
+    top = heapq.nlargest(HOURLY_TOP_PATHS, counts.items(), key=lambda kv: kv[1])
+    return [(path, count, errors[path]) for (path, count) in top]
+
 def output(**kwargs):
     """
     Creates output
+    :kwargs: file_name, data (analyzed log data), percent, num, and
+    output_format: text (default), json or html
+    :returns: (output, first date, last date, hits)
     """
-    analyzed_log_data = kwargs['data']
-    hits = analyzed_log_data['hits']
-    first_date = analyzed_log_data['earliest_date']
-    last_date = analyzed_log_data['latest_date']
-    output = f"Analysis of: {kwargs['file_name']}, from {first_date} to {last_date}:\n"
-    output += f"Hits: {hits}\n"
-
-    if 'visitor_ips' in analyzed_log_data:
-        logger.debug(f"Visitor IPs in data: {analyzed_log_data['visitor_ips']}")
-        output += f"IP addresses: \n"
-        for data in analyzed_log_data['visitor_ips']:
-            perc = analyzed_log_data['visitor_ips'][data]/analyzed_log_data['hits'] * 100
-            if perc >= kwargs['percent']:
-                output += f"{data}: {perc:.1f}%\n"
-
-    ordered_status_data = sorted(analyzed_log_data['status'].items(), 
-                                    key=lambda kv: kv[1], reverse=True)
-    output += "Status Codes:\n"
-    for (code, number) in ordered_status_data:
-        perc = number/analyzed_log_data['hits'] * 100
-        if perc >= kwargs['percent']:
-            output += f"{code}: {perc:.1f}%\n"
-
-    ordered_agent_data = sorted(analyzed_log_data['user_agent'].items(),
-                                key=lambda kv: kv[1], reverse=True)
-    output += f"Number of user agents: {len(ordered_agent_data)}\n"
-    for (agent, number) in ordered_agent_data:
-        perc = number/analyzed_log_data['hits'] * 100
-        if perc >= kwargs['percent']:
-            output += f"User agent {agent}: {perc:.1f}%\n"
-
-    i = 0
-    ordered_pages_visited = sorted(analyzed_log_data['pages_visited'].items(), key=lambda kv: kv[1], reverse=True)
-    output += f"Number of pages visited: {len(ordered_pages_visited)}\n"
-    output += f"Top {kwargs['num']} pages:\n"
-    for (page, number) in ordered_pages_visited:
-        perc = number/analyzed_log_data['hits'] * 100
-        output += f"Page {page}: {number} {perc:.1f}%\n"
-        i += 1
-        if i > kwargs['num']:
-            break
-
-    return (output, first_date, last_date, hits)
+    report = build_report(kwargs['data'], kwargs['file_name'], kwargs['percent'], kwargs['num'])
+    output = RENDERERS[kwargs.get('output_format', 'text')](report)
+
+    return (output, report['first_date'], report['last_date'], report['hits'])
 
 def domain_log_reports(domain, report_type):
     """
     Reports of log reports
     """
     configs = get_configs()
-    # get filtered list
-    file_list = get_file_list(
-        region=configs['region'],
-        profile=configs['profile'],
-        bucket=configs['log_storage_bucket'],
-        domain=domain,
-        filter='Output'
-    )
-
-    if not file_list:
-        return False
-
-    # Sort by date
-    sorted_list = sorted(file_list, key=lambda i: i['date'], reverse=True)
-
-    if report_type == 'latest':
-        output_contents = get_output_contents(
-            bucket=configs['log_storage_bucket'],
-            profile=configs['profile'],
-            region=configs['region'],
-            output_file=sorted_list[0]['file_name'],
-            local_tmp=configs['local_tmp'])
-        return output_contents
+    s3simple = S3Simple(region_name=configs['region'],
+                        bucket_name=configs['log_storage_bucket'],
+                        profile=configs['profile'])
+    index = open_log_index(configs, s3simple)
+    try:
+        latest = index.latest(OUTPUT_KIND, domain, 1)
+        if not latest:
+            return False
+
+        if report_type == 'latest':
+            return index.contents(latest[0]['file_name'])
+    finally:
+        index.close()
 
 def domain_log_list(domain, num):
     """
     List of domain logs
     """
     configs = get_configs()
-    # get filtered list
-    file_list = get_file_list(
-        region=configs['region'],
-        profile=configs['profile'],
-        bucket=configs['log_storage_bucket'],
-        domain=domain,
-        filter='Raw'
-    )
-
-    if not file_list:
+    s3simple = S3Simple(region_name=configs['region'],
+                        bucket_name=configs['log_storage_bucket'],
+                        profile=configs['profile'])
+    index = open_log_index(configs, s3simple)
+    try:
+        latest = index.latest(RAW_LOG_KIND, domain, num)
+    finally:
+        index.close()
+
+    if not latest:
         return False
 
-    sorted_list = sorted(file_list, key=lambda i: i['date'], reverse=True)
-
-    return sorted_list[0:num]
-
-def get_output_contents(**kwargs):
-    """
-    Gets the contents of specific output file
-    """
-    s3simple = S3Simple(region_name=kwargs['region'],
-                        bucket_name=kwargs['bucket'],
-                        profile=kwargs['profile'])
-    local_file_name = kwargs['local_tmp'] + '/' + kwargs['output_file']
-    s3simple.download_file(file_name=kwargs['output_file'], output_file=local_file_name)
-
-    with open(local_file_name) as f:
-        output = f.read()
-
-    return output
-
-def get_file_list(**kwargs):
-    """
-    Get the right list of files, keyed by date
-    """
-    s3simple = S3Simple(region_name=kwargs['region'],
-                        bucket_name=kwargs['bucket'],
-                        profile=kwargs['profile'])
-    file_list = s3simple.s3_bucket_contents()
-    filtered_list = []
-    for single_file in file_list:
-        if (kwargs['filter'] in single_file) and (kwargs['domain'] in single_file):
-            date_search = '[0-9]{2}[-][a-zA-Z]{3}-20[0-9]{2}:[0-9]{2}:[0-9]{2}:[0-9]{2}'
-            match = re.search(date_search, single_file)
-            date = datetime.datetime.strptime(match.group(0),'%d-%b-%Y:%H:%M:%S')
-            filtered_list.append({'date': date, 'file_name': single_file})
+    return latest
 
-    return filtered_list
-    
 def get_domain_data(domain):
     """
     Get domain data
     """
-    load_dotenv()
-
-    engine = db.create_engine(os.environ['DATABASE_URL'])
-    connection = engine.connect()
-    metadata = db.MetaData()
-
-    domains = db.Table('domains', metadata, autoload=True, autoload_with=engine)
-
-    ## Get domain id
-    query = db.select([domains])
-    result = connection.execute(query).fetchall()
-    
-    domain_data = {
-        'id': False
-    }
-    for entry in result:
-        d_id, domain_fetched, ext_ignore, paths_ignore = entry
-        if domain_fetched in domain:
-            domain_data['id'] = d_id
-            domain_data['ext_ignore'] = ext_ignore
-            domain_data['paths_ignore'] = paths_ignore
-    
-    if not domain_data['id']: # we've not seen it before, add it
-        insert = domains.insert().values(domain=domain)
-        result = connection.execute(insert)
-        domain_data['id'] = result.inserted_primary_key[0]
+    domains = get_table('domains')
+
+    with connect() as connection:
+        ## Get domain id
+        query = db.select([domains])
+        result = connection.execute(query).fetchall()
+
+        domain_data = {
+            'id': False,
+            'ext_ignore': None,
+            'paths_ignore': None
+        }
+        for entry in result:
+            d_id, domain_fetched, ext_ignore, paths_ignore = entry
+            if domain_fetched in domain:
+                domain_data['id'] = d_id
+                domain_data['ext_ignore'] = ext_ignore
+                domain_data['paths_ignore'] = paths_ignore
+
+        if not domain_data['id']: # we've not seen it before, add it
+            insert = domains.insert().values(domain=domain)
+            result = connection.execute(insert)
+            domain_data['id'] = result.inserted_primary_key[0]
 
     return domain_data
 
 def report_save(**kwargs):
     """
     Saving report to database
+    :kwarg replace: if True, a report saved earlier for the same domain,
+    log type and first date is updated instead of adding another
     """
     domain_data = get_domain_data(kwargs['domain'])
     domain_id = domain_data['id']
-    load_dotenv()
-
-    engine = db.create_engine(os.environ['DATABASE_URL'])
-    connection = engine.connect()
-    metadata = db.MetaData()
-    log_reports = db.Table('log_reports', metadata, autoload=True, autoload_with=engine)
+    log_reports = get_table('log_reports')
 
     # Save report
     report_data = {
@@ -289,12 +446,145 @@ def report_save(**kwargs):
             'hits':kwargs['hits'],
             'first_date_of_log':kwargs['first_date_of_log'],
             'last_date_of_log':kwargs['last_date_of_log'],
-            'log_type':kwargs['log_type']
+            'log_type':kwargs['log_type'],
+            'unique_visitors':kwargs.get('unique_visitors'),
+            'report_data':kwargs.get('report_data')
         }
-    insert = log_reports.insert().values(**report_data)
-    result = connection.execute(insert)
-    report_id = result.inserted_primary_key[0]
+    with connect() as connection:
+        with connection.begin():
+            existing = None
+            if kwargs.get('replace'):
+                select = db.select([log_reports.c.id]).where(db.and_(
+                    log_reports.c.domain_id == domain_id,
+                    log_reports.c.log_type == kwargs['log_type'],
+                    log_reports.c.first_date_of_log == kwargs['first_date_of_log']))
+                existing = connection.execute(select).scalar()
+            if existing:
+                connection.execute(log_reports.update().where(log_reports.c.id == existing).values(**report_data))
+                report_id = existing
+            else:
+                result = connection.execute(log_reports.insert().values(**report_data))
+                report_id = result.inserted_primary_key[0]
 
     logger.debug(f"Report ID: {report_id}")
 
+    return report_id
+
+def hourly_save(**kwargs):
+    """
+    Saves hourly traffic buckets for a domain from one log file.
+    Buckets saved earlier from the same file are replaced, so
+    reprocessing a file doesn't count its traffic twice
+    :kwarg domain
+    :kwarg source: S3 key of the log file the buckets came from
+    :kwarg hourly: the 'hourly' dict from analyze_lines
+    """
+    domain_data = get_domain_data(kwargs['domain'])
+    domain_id = domain_data['id']
+    log_hourly = get_table('log_hourly')
+
+    hourly_data = []
+    for (hour, bucket) in kwargs['hourly'].items():
+        hourly_data.append({
+            'domain_id': domain_id,
+            'source': kwargs['source'],
+            'hour': hour,
+            'hits': bucket['hits'],
+            'status_2xx': bucket['status'].get('2xx', 0),
+            'status_3xx': bucket['status'].get('3xx', 0),
+            'status_4xx': bucket['status'].get('4xx', 0),
+            'status_5xx': bucket['status'].get('5xx', 0),
+            'unique_visitors': bucket['visitors'].count(),
+            'visitors_hll': bucket['visitors'].encode(),
+            'top_paths': json.dumps([(path, count) for (path, count, error) in bucket['top_paths']])
+        })
+    with connect() as connection:
+        with connection.begin():
+            delete = log_hourly.delete().where(log_hourly.c.source == kwargs['source'])
+            connection.execute(delete)
+            if hourly_data:
+                connection.execute(log_hourly.insert(), hourly_data)
+
+    return
+
+def processed_log_list():
+    """
+    Manifest of raw log files that have already been analyzed
+    :returns: dict of etags, keyed by S3 key
+    """
+    processed_logs = get_table('processed_logs')
+
+    query = db.select([processed_logs.c.key, processed_logs.c.etag])
+    with connect() as connection:
+        result = connection.execute(query).fetchall()
+
+    return {key: etag for (key, etag) in result}
+
+def processed_log_save(**kwargs):
+    """
+    Records a raw log file in the manifest of analyzed files
+    :kwarg key: S3 key of the raw log file
+    :kwarg etag
+    :kwarg size
+    :kwarg log_report_id: report made from it, if any
+    :kwarg datetime
+    """
+    processed_logs = get_table('processed_logs')
+
+    processed_data = {
+            'key': kwargs['key'],
+            'etag': kwargs['etag'],
+            'size': kwargs['size'],
+            'log_report_id': kwargs['log_report_id'],
+            'date_processed': kwargs['datetime']
+        }
+    query = db.select([processed_logs.c.id]).where(processed_logs.c.key == kwargs['key'])
+    with connect() as connection:
+        existing = connection.execute(query).fetchone()
+        if existing: # reprocessed
+            update = processed_logs.update().where(processed_logs.c.id == existing[0]).values(**processed_data)
+            connection.execute(update)
+        else:
+            insert = processed_logs.insert().values(**processed_data)
+            connection.execute(insert)
+
+    return
+
+def processed_log_rename(renames):
+    """
+    Follows raw log files to new keys in the manifest of analyzed files
+    and in the hourly buckets made from them, so moving files doesn't
+    get them analyzed again. A copy can have a different etag; it only
+    replaces the old one if that was the version analyzed
+    :arg renames: dict of (old etag, new key, new etag), keyed by old key
+    """
+    processed_logs = get_table('processed_logs')
+    log_hourly = get_table('log_hourly')
+
+    with connect() as connection:
+        for (old_key, (old_etag, new_key, new_etag)) in renames.items():
+            connection.execute(processed_logs.update().where(
+                db.and_(processed_logs.c.key == old_key, processed_logs.c.etag == old_etag)).values(etag=new_etag))
+            connection.execute(processed_logs.update().where(processed_logs.c.key == old_key).values(key=new_key))
+            connection.execute(log_hourly.update().where(log_hourly.c.source == old_key).values(source=new_key))
+
     return
+
+def bucket_objects(s3simple, kind=None, domain=None, since=None):
+    """
+    Lists the objects in a bucket along with their etag and size
+    :arg: s3simple - S3Simple for the bucket
+    :arg: kind - only list objects of this kind (see log_keys), in the
+    partitions for domain and since; default is the whole bucket
+    :yields: dicts with key, etag and size
+    """
+    if kind:
+        s3_objects = partitioned_objects(s3simple, kind, domain, since)
+    else:
+        s3_objects = s3simple.bucket.objects.all()
+    for s3_object in s3_objects:
+        yield {
+            'key': s3_object.key,
+            'etag': s3_object.e_tag.strip('"'),
+            'size': s3_object.size
+        }
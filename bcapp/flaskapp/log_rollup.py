@@ -0,0 +1,148 @@
+"""
+Roll up the stored per-file log analyses into daily, weekly or monthly
+reports per domain, without downloading the raw logs again
+
+version 0.1
+"""
+import datetime
+import click
+import logging
+from system_utilities import get_configs
+from simple_AWS.s3_functions import *
+from log_reporting_utilities import report_save, merge_analyses, LOG_DATE_FORMAT
+from log_report_formats import build_report, render_text, render_json
+from log_artifacts import stored_analyses
+from log_keys import partitioned_key, ROLLUP_KIND
+
+logger = logging.getLogger('logger')
+
+PERIODS = ['daily', 'weekly', 'monthly']
+
+@click.command()
+@click.option('--period', type=click.Choice(PERIODS), default='weekly', help="Length of the rollup. Default is weekly")
+@click.option('--domain', type=str, help="Domain to roll up (default is all)")
+@click.option('--range', type=int, help="Days of log age to roll up. Default is 31", default=31)
+@click.option('--percent', type=int, help="Floor percentage to display for agents and codes (default is 5%)", default=5)
+@click.option('--num', type=int, help="Top number of pages to display (default is 10", default=10)
+@click.option('--save', is_flag=True, default=False, help="Save the rollups as log reports and output files")
+
+def rollup(period, domain, range, percent, num, save):
+    configs = get_configs()
+    now = datetime.datetime.now()
+
+    s3simple = S3Simple(region_name=configs['region'],
+                                profile=configs['profile'],
+                                bucket_name=configs['log_storage_bucket'])
+
+    logger.debug("Getting log analyses from S3 bucket...")
+    rollups = {}
+    # start and end of each period
+    bounds = {}
+    # rollups with analyses whose logs run on past the end of the period
+    overlapping = set()
+    since = now - datetime.timedelta(days=range)
+    for stored in stored_analyses(s3simple, domain, since):
+        analysis = stored['analysis']
+        earliest = datetime.datetime.strptime(analysis['earliest_date'], LOG_DATE_FORMAT)
+        # only whole periods: the first one in the range would be missing
+        # its older analyses, and the current one isn't over yet
+        (start, end) = period_bounds(earliest, period)
+        if start < since or end > now:
+            logger.debug(f"Skipping {stored['key']}, from a period that isn't wholly in the range")
+            continue
+        # each analysis is counted in the period its log starts in, as
+        # only its hourly buckets and daily visitors could be split up
+        rollup_key = (stored['domain'], period_name(earliest, period))
+        bounds[rollup_key[1]] = (start, end)
+        latest = datetime.datetime.strptime(analysis['latest_date'], LOG_DATE_FORMAT)
+        if period_name(latest, period) != rollup_key[1]:
+            logger.warning(f"{stored['key']} runs past the end of {rollup_key[1]}, all of it is counted there")
+            overlapping.add(rollup_key)
+        logger.debug(f"Adding {stored['key']} to {rollup_key}")
+        if rollup_key in rollups:
+            merge_analyses(rollups[rollup_key], analysis)
+        else:
+            rollups[rollup_key] = analysis
+
+    for (rollup_domain, period_key) in sorted(rollups):
+        title = f"{rollup_domain} {period} {period_key}"
+        if (rollup_domain, period_key) in overlapping:
+            title += " (includes logs running into the next period)"
+        report = build_report(rollups[(rollup_domain, period_key)], title, percent, num)
+        output_text = render_text(report)
+        print(output_text)
+        if not save:
+            continue
+
+        # saving the same period again replaces what was saved before
+        (start, end) = bounds[period_key]
+        logger.debug("Saving rollup file....")
+        key = partitioned_key(ROLLUP_KIND, rollup_domain, start,
+                              ROLLUP_KIND + '_' + rollup_domain + '_' + period + '-' + period_key + '.txt')
+        s3simple.put_to_s3(key=key, body=output_text)
+
+        logger.debug("Sending Report to Database...")
+        report_save(
+            domain=rollup_domain,
+            datetime=now,
+            report_text=output_text,
+            hits=report['hits'],
+            first_date_of_log=start,
+            last_date_of_log=end,
+            log_type='rollup-' + period,
+            unique_visitors=report['unique_visitors'],
+            report_data=render_json(report),
+            replace=True
+            )
+
+    return
+
+def period_name(date, period):
+    """
+    Name of the day, week or month a date falls in
+    :arg date: datetime
+    :arg period: daily, weekly or monthly
+    :returns string: 2021-03-08, 2021-W10 (ISO week) or 2021-03
+    """
+    if period == 'daily':
+        return date.strftime('%Y-%m-%d')
+    if period == 'weekly':
+        (year, week, weekday) = date.isocalendar()
+        return f"{year}-W{week:02d}"
+    return date.strftime('%Y-%m')
+
+def period_bounds(date, period):
+    """
+    Start and end of the day, week or month a date falls in
+    :arg date: datetime
+    :arg period: daily, weekly or monthly
+    :returns (start, end) datetimes, the end being the start of the next
+    """
+    start = datetime.datetime(date.year, date.month, date.day)
+    if period == 'daily':
+        return (start, start + datetime.timedelta(days=1))
+    if period == 'weekly':
+        start -= datetime.timedelta(days=start.weekday())
+        return (start, start + datetime.timedelta(days=7))
+    start = start.replace(day=1)
+    return (start, (start + datetime.timedelta(days=32)).replace(day=1))
+
+if __name__ == '__main__':
+    configs = get_configs()
+    log = configs['log_level']
+    logger = logging.getLogger('logger')  # instantiate clogger
+    logger.setLevel(logging.DEBUG)  # pass DEBUG and higher values to handler
+
+    ch = logging.StreamHandler()  # use StreamHandler, which prints to stdout
+    ch.setLevel(configs['log_level'])  # ch handler uses the configura
+
+    # create formatter
+    # display the function name and logging level in columnar format if
+    # logging mode is 'DEBUG'
+    formatter = logging.Formatter('[%(funcName)24s] [%(levelname)8s] %(message)s')
+
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    rollup()
@@ -0,0 +1,216 @@
+"""
+Fixed-size summaries of log traffic, for when exact counters
+would grow without bound
+"""
+import zlib
+import math
+import heapq
+import base64
+import hashlib
+
+# How many recently added values a HyperLogLog remembers to skip rehashing
+_RECENT_SIZE = 8192
+
+class SpaceSaving(object):
+    """
+    Space-Saving heavy hitter summary (Metwally et al.)
+
+    Keeps counters for at most `capacity` keys. When a new key arrives
+    and the summary is full, the key with the smallest count is replaced
+    and the new key inherits that count as its possible overcount
+    (error). Any key seen more than total/capacity times is guaranteed
+    to be kept, and a kept key's true count lies between
+    count - error and count.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+        # (count, key) for every kept key - counts may be stale (too low),
+        # and are refreshed when they reach the top of the heap
+        self._heap = []
+
+    def add(self, key, count=1):
+        """
+        Counts a key
+        :arg key
+        :arg count: how many times it was seen (default 1)
+        """
+        self.total += count
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return
+        if len(counts) < self.capacity:
+            counts[key] = count
+            self.errors[key] = 0
+            heapq.heappush(self._heap, (count, key))
+            return
+        heap = self._heap
+        while True:
+            (smallest, smallest_key) = heap[0]
+            current = counts[smallest_key]
+            if current == smallest:
+                break
+            heapq.heapreplace(heap, (current, smallest_key))
+        del counts[smallest_key]
+        del self.errors[smallest_key]
+        counts[key] = smallest + count
+        self.errors[key] = smallest
+        heapq.heapreplace(heap, (smallest + count, key))
+
+    def merge(self, other):
+        """
+        Adds the counts of another summary to this one (Agarwal et al.,
+        "Mergeable Summaries"). A key missing from a full summary may have
+        been seen up to that summary's smallest count times, so that is
+        added to its count and error, and the largest counts are kept
+        """
+        self_floor = self._floor()
+        other_floor = other._floor()
+        counts = {}
+        errors = {}
+        for key in set(self.counts) | set(other.counts):
+            counts[key] = self.counts.get(key, self_floor) + other.counts.get(key, other_floor)
+            errors[key] = self.errors.get(key, self_floor) + other.errors.get(key, other_floor)
+        kept = heapq.nlargest(self.capacity, counts.items(), key=lambda kv: kv[1])
+        self.counts = dict(kept)
+        self.errors = {key: errors[key] for key in self.counts}
+        self._heap = [(count, key) for (key, count) in kept]
+        heapq.heapify(self._heap)
+        self.total += other.total
+        return self
+
+    def _floor(self):
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def to_dict(self):
+        """
+        JSON-compatible form of the summary
+        """
+        return {
+            'capacity': self.capacity,
+            'total': self.total,
+            'counts': self.counts,
+            'errors': self.errors
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Rebuilds a summary from to_dict()
+        """
+        summary = cls(data['capacity'])
+        summary.total = data['total']
+        summary.counts = dict(data['counts'])
+        summary.errors = dict(data['errors'])
+        summary._heap = [(count, key) for (key, count) in summary.counts.items()]
+        heapq.heapify(summary._heap)
+        return summary
+
+    def error(self, key):
+        """
+        Largest amount by which a key's count may be overstated
+        """
+        return self.errors.get(key, 0)
+
+    def items(self):
+        """
+        (key, count) for every kept key
+        """
+        return self.counts.items()
+
+    def top(self, num):
+        """
+        The num keys with the highest counts
+        :returns list of (key, count, error), highest count first
+        """
+        top_counts = heapq.nlargest(num, self.counts.items(), key=lambda kv: kv[1])
+        return [(key, count, self.errors[key]) for (key, count) in top_counts]
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def __repr__(self):
+        return 'SpaceSaving({}, {!r})'.format(self.capacity, self.counts)
+
+class HyperLogLog(object):
+    """
+    HyperLogLog cardinality estimator (Flajolet et al.)
+
+    Estimates the number of distinct values added using 2**precision
+    one-byte registers (4KB at the default precision of 12), with a
+    standard error of about 1.04/sqrt(2**precision), 1.6% by default.
+    Estimators with the same precision can be merged, so per-file or
+    per-day counts can be combined later without the original values.
+    """
+    def __init__(self, precision=12, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        if registers is None:
+            self.registers = bytearray(self.size)
+        else:
+            self.registers = bytearray(registers)
+        # values added recently, so repeat visitors aren't hashed again
+        self._recent = set()
+
+    def add(self, value):
+        """
+        Adds a value (such as a visitor IP address)
+        """
+        if value in self._recent:
+            return
+        if len(self._recent) >= _RECENT_SIZE:
+            self._recent.clear()
+        self._recent.add(value)
+        hashed = int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        rank = (64 - self.precision) - (hashed & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Adds the values counted by another estimator to this one
+        """
+        if other.precision != self.precision:
+            raise ValueError("Can't merge HyperLogLogs with different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        """
+        Estimated number of distinct values added
+        """
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # small range correction (linear counting)
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    def encode(self):
+        """
+        Compact text form of the estimator (compressed registers),
+        for storing in the database
+        """
+        return '{}:{}'.format(self.precision, base64.b64encode(zlib.compress(bytes(self.registers))).decode())
+
+    @classmethod
+    def decode(cls, encoded):
+        """
+        Rebuilds an estimator from encode()
+        """
+        (precision, registers) = encoded.split(':', 1)
+        return cls(int(precision), zlib.decompress(base64.b64decode(registers)))
+
+    def __repr__(self):
+        return 'HyperLogLog({}, ~{})'.format(self.precision, self.count())
@@ -5,138 +5,307 @@ version 0.2
 """
 import sys
 import os
+import copy
 import datetime
 import time
+import concurrent.futures
 import click
-import sh
 import logging
 from system_utilities import get_configs
 from simple_AWS.s3_functions import *
-from log_reporting_utilities import analyze_file, output, report_save
+from log_reporting_utilities import (analyze_file, report_save, open_log_file, open_s3_log, LOG_DECOMPRESSORS,
+    bucket_objects, processed_log_list, processed_log_save, hourly_save, get_domain_data, merge_analyses)
+from log_artifacts import artifact_key, dump_artifact, load_artifact
+from log_keys import (partitioned_key, key_name, RAW_LOG_KIND, OUTPUT_KIND, PARSED_LOG_KIND,
+    ARTIFACT_KIND, PARTITION_DATE_FORMAT)
+from log_agent import AGENT_PREFIX
+from log_sketches import HyperLogLog
+from log_export import ColumnarExporter, pyarrow
+from log_parsers import LOG_FORMATS
+from log_report_formats import build_report, render_text, render_json
 
 logger = logging.getLogger('logger')
 
 @click.command()
 @click.option('--percent', type=int, help="Floor percentage to display for agents and codes (default is 5%)", default=5)
 @click.option('--num', type=int, help="Top number of pages to display (default is 10", default=10)
-@click.option('--unzip', is_flag=True, help="Process zipped log files", default=False)
+@click.option('--unzip', is_flag=True, help="Process compressed (gz, bz2, xz, zst) log files", default=False)
 @click.option('--daemon', is_flag=True, default=False, help="Run in daemon mode. All output goes to a file.")
 @click.option('--range', type=int, help="Days of log file age to analyze. Default is 7", default=7)
+@click.option('--workers', type=int, help="Number of log files to download and analyze in parallel. Default is 1", default=1)
+@click.option('--sketch', type=int, help="Keep approximate counts for at most this many pages and user agents per file")
+@click.option('--reprocess', is_flag=True, default=False, help="Analyze files again even if they have already been analyzed")
+@click.option('--export', is_flag=True, default=False, help="Also save parsed log records as Parquet files per domain and day (needs pyarrow)")
+@click.option('--log_format', type=click.Choice(sorted(LOG_FORMATS)), help="Format of the logs (default is to detect it for each file)")
+@click.option('--bots', is_flag=True, default=False, help="Count bots and crawlers as visitors")
+@click.option('--stage', is_flag=True, default=False, help="Download log files to local_tmp before analyzing them, instead of streaming them from S3")
 
-def analyze(unzip, percent, num, daemon, range):
+def analyze(unzip, percent, num, daemon, range, workers, sketch, reprocess, export, log_format, bots, stage):
 
     import faulthandler; faulthandler.enable()
 
+    if export and not pyarrow:
+        logger.critical("--export needs the pyarrow package!")
+        return
+
     configs = get_configs()
     now = datetime.datetime.now()
-    now_string = now.strftime('%d-%b-%Y:%H:%M:%S')
 
     # TODO: Make this domain specific
     s3simple = S3Simple(region_name=configs['region'],
                                 profile=configs['profile'],
                                 bucket_name=configs['log_storage_bucket'])
 
+    # files analyzed on earlier runs are skipped, unless they've changed
+    if reprocess:
+        processed = {}
+    else:
+        processed = processed_log_list()
+
     # get the file list to analyze
     # read from S3
     logger.debug("Getting files from S3 bucket...")
-    file_list = s3simple.s3_bucket_contents()
-    logger.debug(f"File list: {file_list}")
-    paths = []
-    for ifile in file_list:
-        if (('.gz' in ifile or '.bz2' in ifile) and not unzip):
+    jobs = []
+    since = now - datetime.timedelta(days=range + 1)
+    for s3_object in bucket_objects(s3simple, kind=RAW_LOG_KIND, since=since):
+        ifile = s3_object['key']
+        if ifile.split('.')[-1] in LOG_DECOMPRESSORS and not unzip:
             continue
         logger.debug(f"Processing file: {ifile}")
         try:
-            (prefix, domain, date, filename) = ifile.split('_')
+            (prefix, domain, date, filename) = key_name(ifile).split('_')
         except ValueError:
             continue
-        if prefix != 'RawLogFile':
-            continue
         file_date = datetime.datetime.strptime(date, "%d-%b-%Y:%H:%M:%S")
         numdays = (now - file_date).days
         if numdays > range:
             continue
-        paths.append(f"{domain}|{ifile}")
+        if processed.get(ifile) == s3_object['etag']:
+            logger.debug(f"Already analyzed: {ifile}")
+            continue
+        jobs.append((domain, s3_object))
 
-    logger.debug(f"Paths: {paths}")
+    logger.debug(f"Files to analyze: {[s3_object['key'] for (domain, s3_object) in jobs]}")
 
-    for fpath in paths:
-        if not fpath:
+    # looked up (and new domains added) once here, not in each worker,
+    # which would add a new domain once per file
+    domains = {domain: get_domain_data(domain) for domain in {domain for (domain, s3_object) in jobs}}
+
+    domain_totals = {}
+    if workers > 1:
+        # Downloading and parsing happen in the pool, while results are
+        # saved here in the same order as a serial run
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(process_log_file, domain, s3_object['key'], unzip, percent, num, now, sketch, export,
+                                       log_format, bots, stage, domains[domain])
+                        for (domain, s3_object) in jobs]
+            for ((domain, s3_object), future) in zip(jobs, futures):
+                save_log_results(future.result(), [s3_object], now, domain_totals)
+    else:
+        for (domain, s3_object) in jobs:
+            results = process_log_file(domain, s3_object['key'], unzip, percent, num, now, sketch, export, log_format,
+                                       bots, stage, domains[domain])
+            save_log_results(results, [s3_object], now, domain_totals)
+
+    # analyses shipped by log_agent.py from edge hosts, reported together
+    # for each domain and host, as the agent ships every few minutes
+    logger.debug("Getting edge analyses from S3 bucket...")
+    agent_analyses = {}
+    for s3_object in bucket_objects(s3simple, kind=ARTIFACT_KIND, since=since):
+        if not key_name(s3_object['key']).split('_')[-1].startswith(AGENT_PREFIX):
             continue
-        domain, path = fpath.split('|')
-        
-        #download
-        local_path = configs['local_tmp'] + '/' + path
-        logger.debug(f"Downloading ... domain: {domain} to {local_path}")
-        s3simple.download_file(file_name=path, output_file=local_path)
-        files = [local_path]
-
-        logger.debug(f"File List: {files}")
-
-        all_log_data = []
-        for file_name in files:
-            if 'access' not in file_name:
-                continue
-            file_path = file_name.split('/')
-            file_parts = file_path[-1].split('.')
-            just_file_name = '.'.join(file_path)
-            logger.debug(f"File Name {just_file_name}")
-            ext = file_parts[-1]
-            if ((ext != 'log') and
-                (ext != 'bz2' and ext !='gz')): # not a log file, nor a zipped log file
-                continue
-
-            logger.debug(f"Analyzing... ")
-            if ext == 'bz2' or ext == 'gz':
-                if unzip:
-                    if ext == 'bz2':
-                        raw_data = sh.bunzip2("-k", "-c", file_name)
-                    else:
-                        raw_data = sh.gunzip("-k", "-c", file_name)
-                else:
-                    continue
-            else:
-                with open(file_name) as f:
-                    raw_data = f.read()
-
-            analyzed_data = analyze_file(raw_data, domain)
-            logger.debug(f"Visitor IPs:{analyzed_data['visitor_ips']}!")
-            if analyzed_data['visitor_ips']:
-                log_type = 'nginx'
-            else:
-                log_type = 'eotk'    
-            if not analyzed_data:
-                continue
-            logger.debug(f"Log type: {log_type}")
-            (output_text, first_date, last_date, hits) = output(
-                        file_name=file_name,
-                        data=analyzed_data,
-                        percent=percent,
-                        num=num)
-            logger.debug(output_text)
-
-            logger.debug("Saving log analysis file...")
-            key = 'LogAnalysis_' + just_file_name + '_' + now_string + '.json'
-            body = str(analyzed_data)
-            s3simple.put_to_s3(key=key, body=body)
-
-            logger.debug("Saving output file....")
-            key = 'LogAnalysisOutput_' + domain + '_' + log_type + '_' + now_string + '.txt'
-            s3simple.put_to_s3(key=key, body=output_text)
-
-            logger.debug(f"Deleting local temporary file {local_path}...")
-            os.remove(local_path)
-
-            logger.debug("Sending Report to Database...")
-            report_save(
-                domain=domain,
-                datetime=now,
-                report_text=output_text,
-                hits=hits,
-                first_date_of_log=first_date,
-                last_date_of_log=last_date,
-                log_type=log_type
-                )
+        if processed.get(s3_object['key']) == s3_object['etag']:
+            continue
+        try:
+            artifact = load_artifact(s3simple.bucket.Object(s3_object['key']).get()['Body'].read())
+        except ValueError as error:
+            logger.warning(f"Skipping edge analysis {s3_object['key']}: {error}")
+            save_log_results(False, [s3_object], now, domain_totals)
+            continue
+        host = artifact['source'].split(':')[1]
+        agent_analyses.setdefault((artifact['domain'], host), []).append((s3_object, artifact))
+    for (domain, host) in sorted(agent_analyses):
+        s3_objects = [s3_object for (s3_object, artifact) in agent_analyses[(domain, host)]]
+        results = process_agent_analyses(s3simple, domain, host, agent_analyses[(domain, host)], percent, num, now)
+        save_log_results(results, s3_objects, now, domain_totals)
+
+    for domain in domain_totals:
+        totals = domain_totals[domain]
+        logger.debug(f"Domain {domain}: {totals['files']} files, {totals['hits']} hits, about {totals['visitors'].count()} unique visitors")
+
+    return
+
+def process_log_file(domain, path, unzip, percent, num, now, sketch=None, export=False, log_format=None,
+                     bots=False, stage=False, domain_data=None):
+    """
+    Streams (or downloads), analyzes and stores the analysis of one raw log file
+    Runs in a worker process when --workers is more than 1
+    :arg domain
+    :arg path: S3 key of the raw log file
+    :arg log_format: name of the log format, detected if not given
+    :arg bots: count bots and crawlers as visitors
+    :arg stage: download the file to local_tmp first, rather than
+    reading it straight from S3
+    :arg domain_data: from get_domain_data, looked up if not given
+    :returns dict of results for report_save, or False if nothing was analyzed
+    """
+    configs = get_configs()
+    now_string = now.strftime('%d-%b-%Y:%H:%M:%S')
+    s3simple = S3Simple(region_name=configs['region'],
+                                profile=configs['profile'],
+                                bucket_name=configs['log_storage_bucket'])
+
+    if 'access' not in path:
+        return False
+    ext = path.split('.')[-1]
+    if ((ext not in ('log', 'json')) and
+        (ext not in LOG_DECOMPRESSORS)): # not a log file, nor a zipped log file
+        return False
+    if ext in LOG_DECOMPRESSORS and not unzip:
+        return False
+
+    (prefix, raw_domain, raw_date, raw_name) = key_name(path).split('_')
+    exporter = None
+    if export:
+        exporter = ColumnarExporter(configs['local_tmp'] + '/ParsedLogs_' + domain + '_' + raw_date + '_' + raw_name)
+
+    analyze_options = {
+        'sketch_size': sketch,
+        'record_sink': exporter.add if exporter else None,
+        'log_format': LOG_FORMATS[log_format] if log_format else None,
+        'count_bots': bots,
+        'domain_data': domain_data
+    }
+    if stage:
+        file_name = configs['local_tmp'] + '/' + key_name(path)
+        logger.debug(f"Downloading ... domain: {domain} to {file_name}")
+        s3simple.download_file(file_name=path, output_file=file_name)
+        logger.debug(f"Analyzing... ")
+        try:
+            with open_log_file(file_name) as f:
+                analyzed_data = analyze_file(f, domain, **analyze_options)
+        finally:
+            logger.debug(f"Deleting local temporary file {file_name}...")
+            os.remove(file_name)
+    else:
+        logger.debug(f"Analyzing {path} from S3...")
+        with open_s3_log(s3simple, path) as f:
+            analyzed_data = analyze_file(f, domain, **analyze_options)
+
+    if not analyzed_data:
+        if exporter:
+            exporter.discard()
+        return False
+
+    if exporter:
+        logger.debug("Saving columnar files...")
+        for (day, parquet_file) in exporter.close().items():
+            key = partitioned_key(PARSED_LOG_KIND, domain, datetime.datetime.strptime(day, PARTITION_DATE_FORMAT),
+                                  PARSED_LOG_KIND + '_' + domain + '_' + day + '_' + raw_date + '_' + raw_name + '.parquet')
+            s3simple.send_file_to_s3(local_file=parquet_file, s3_file=key)
+            os.remove(parquet_file)
+    log_type = analyzed_data['log_type']
+    logger.debug(f"Log type: {log_type}")
+    report = build_report(analyzed_data, path, percent, num)
+    output_text = render_text(report)
+    logger.debug(output_text)
+
+    logger.debug("Saving log analysis file...")
+    key = artifact_key(domain, raw_date, raw_name)
+    body = dump_artifact(analyzed_data, domain=domain, log_type=log_type, source=path, analyzed=now_string)
+    s3simple.bucket.put_object(Key=key, Body=body)
+
+    logger.debug("Saving output file....")
+    key = partitioned_key(OUTPUT_KIND, domain, now, OUTPUT_KIND + '_' + domain + '_' + log_type + '_' + now_string + '.txt')
+    s3simple.put_to_s3(key=key, body=output_text)
+
+    return {
+        'domain': domain,
+        'report_text': output_text,
+        'report_data': render_json(report),
+        'hits': report['hits'],
+        'first_date_of_log': report['first_date'],
+        'last_date_of_log': report['last_date'],
+        'log_type': log_type,
+        'unique_visitors': analyzed_data['unique_visitors'],
+        'visitor_hll': analyzed_data['visitor_hll'],
+        'hourly': [analyzed_data['hourly']]
+    }
+
+def process_agent_analyses(s3simple, domain, host, artifacts, percent, num, now):
+    """
+    Makes one report of the analyses an edge host shipped for a domain
+    since the last run
+    :arg host: name of the edge host
+    :arg artifacts: list of (s3_object, artifact) from load_artifact
+    :returns dict of results for report_save
+    """
+    # the hourly buckets of each are saved as they were shipped
+    hourly = [artifact['analysis']['hourly'] for (s3_object, artifact) in artifacts]
+    analyzed_data = copy.deepcopy(artifacts[0][1]['analysis'])
+    for (s3_object, artifact) in artifacts[1:]:
+        merge_analyses(analyzed_data, artifact['analysis'])
+    log_type = artifacts[0][1]['log_type']
+    report = build_report(analyzed_data, f"agent:{host} ({len(artifacts)} analyses)", percent, num)
+    output_text = render_text(report)
+    logger.debug(output_text)
+
+    logger.debug("Saving output file....")
+    now_string = now.strftime('%d-%b-%Y:%H:%M:%S')
+    output_key = partitioned_key(OUTPUT_KIND, domain, now, OUTPUT_KIND + '_' + domain + '_' + log_type + '-' +
+                                 host.replace('_', '-') + '_' + now_string + '.txt')
+    s3simple.put_to_s3(key=output_key, body=output_text)
+
+    return {
+        'domain': domain,
+        'report_text': output_text,
+        'report_data': render_json(report),
+        'hits': report['hits'],
+        'first_date_of_log': report['first_date'],
+        'last_date_of_log': report['last_date'],
+        'log_type': log_type,
+        'unique_visitors': analyzed_data['unique_visitors'],
+        'visitor_hll': analyzed_data['visitor_hll'],
+        'hourly': hourly
+    }
+
+def save_log_results(results, s3_objects, now, domain_totals):
+    """
+    Sends the results of log files (one raw log file, or the analyses an
+    edge host shipped) to the database, records the files as processed,
+    and adds the results to the per-domain totals for the run
+    :arg results: from process_log_file or process_agent_analyses, whose
+    'hourly' has the hourly buckets of each of s3_objects, in order
+    :arg s3_objects: list of the files the results came from
+    """
+    if not results:
+        for s3_object in s3_objects:
+            processed_log_save(key=s3_object['key'], etag=s3_object['etag'], size=s3_object['size'],
+                                log_report_id=None, datetime=now)
+        return
+    logger.debug("Sending Report to Database...")
+    report_id = report_save(
+        domain=results['domain'],
+        datetime=now,
+        report_text=results['report_text'],
+        hits=results['hits'],
+        first_date_of_log=results['first_date_of_log'],
+        last_date_of_log=results['last_date_of_log'],
+        log_type=results['log_type'],
+        unique_visitors=results['unique_visitors'],
+        report_data=results['report_data']
+        )
+    for (s3_object, hourly) in zip(s3_objects, results['hourly']):
+        hourly_save(domain=results['domain'], source=s3_object['key'], hourly=hourly)
+        processed_log_save(key=s3_object['key'], etag=s3_object['etag'], size=s3_object['size'],
+                            log_report_id=report_id, datetime=now)
+
+    domain = results['domain']
+    if domain not in domain_totals:
+        domain_totals[domain] = {'files': 0, 'hits': 0, 'visitors': HyperLogLog()}
+    domain_totals[domain]['files'] += len(s3_objects)
+    domain_totals[domain]['hits'] += results['hits']
+    domain_totals[domain]['visitors'].merge(results['visitor_hll'])
 
     return
 
@@ -0,0 +1,178 @@
+"""
+Uploads of log files to S3, several at a time
+
+Large files go up in parts (multipart uploads), failed uploads are
+retried with exponential backoff, and a summary of the throughput is
+kept, since edge hosts are often on slow or unreliable links
+
+Files already uploaded are remembered in a local state file, by path,
+size, modification time and content hash, so unchanged files (and
+renamed copies of them, as log rotation makes) aren't sent again
+"""
+import os
+import hashlib
+import time
+import random
+import logging
+import concurrent.futures
+import boto3.s3.transfer
+import boto3.exceptions
+import botocore.exceptions
+from system_utilities import load_state, save_state
+
+logger = logging.getLogger('logger')
+
+# Files larger than this are uploaded in parts of MULTIPART_CHUNKSIZE
+MULTIPART_THRESHOLD = 16 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+# Parts of one file uploaded at the same time
+MULTIPART_CONCURRENCY = 4
+
+UPLOAD_RETRIES = 4
+# Seconds before the first retry, doubled for each one after
+UPLOAD_BACKOFF = 2.0
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def file_hash(local_file):
+    """
+    SHA-256 of a file's contents, read in blocks
+    :returns hex digest
+    """
+    digest = hashlib.sha256()
+    with open(local_file, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class UploadState(object):
+    """
+    Files already uploaded, kept in a JSON file between runs:
+    {path: {'size', 'mtime', 'sha256', 'key'}}
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.files = load_state(file_name)
+        self.keys = {entry['sha256']: entry['key'] for entry in self.files.values()}
+
+    def uploaded_key(self, local_file, stat):
+        """
+        Where the contents of a file were already uploaded to. The file is
+        only hashed if its size or modification time changed
+        :arg local_file
+        :arg stat: os.stat of the file
+        :returns (key or None, sha256 of the contents)
+        """
+        entry = self.files.get(local_file)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return (entry['key'], entry['sha256'])
+        sha256 = file_hash(local_file)
+        return (self.keys.get(sha256), sha256)
+
+    def record(self, local_file, stat, sha256, key):
+        self.files[local_file] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': sha256,
+            'key': key
+        }
+        self.keys[sha256] = key
+
+    def save(self):
+        """
+        Writes the state, forgetting files that no longer exist
+        """
+        files = {path: entry for (path, entry) in self.files.items() if os.path.exists(path)}
+        save_state(self.file_name, files)
+
+class UploadSummary(object):
+    """
+    Totals for a run of uploads
+    """
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.failed = []
+        self.sent = []
+        self.started = time.monotonic()
+        self.seconds = 0.0
+
+    def add(self, size):
+        self.files += 1
+        self.bytes += size
+
+    def finish(self):
+        self.seconds = time.monotonic() - self.started
+
+    @property
+    def bytes_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.bytes / self.seconds
+
+    def __str__(self):
+        return (f"Uploaded {self.files} files, {self.bytes} bytes in {self.seconds:.1f}s "
+                f"({self.bytes_per_second / 1024:.1f} KB/s), {len(self.failed)} failed")
+
+def upload_file(s3simple, local_file, key, retries=UPLOAD_RETRIES, backoff=UPLOAD_BACKOFF):
+    """
+    Uploads one file, in parts if it is large, retrying on failure
+    :arg s3simple: S3Simple for the bucket
+    :arg local_file
+    :arg key
+    :returns size of the file in bytes
+    :raises the last error if every attempt fails
+    """
+    config = boto3.s3.transfer.TransferConfig(
+        multipart_threshold=MULTIPART_THRESHOLD,
+        multipart_chunksize=MULTIPART_CHUNKSIZE,
+        max_concurrency=MULTIPART_CONCURRENCY
+    )
+    # clients can be shared between threads, resources can't
+    client = s3simple.s3.meta.client
+    for attempt in range(retries + 1):
+        try:
+            client.upload_file(local_file, s3simple.bucket.name, key, Config=config)
+            return os.path.getsize(local_file)
+        except (boto3.exceptions.S3UploadFailedError, botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError) as error:
+            if attempt == retries:
+                raise
+            # jitter, so uploads that failed together don't retry together
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+            logger.warning(f"Upload of {local_file} failed ({error}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def upload_files(s3simple, uploads, workers=4, retries=UPLOAD_RETRIES, backoff=UPLOAD_BACKOFF):
+    """
+    Uploads files, several at a time
+    :arg s3simple: S3Simple for the bucket
+    :arg uploads: iterable of (local file, key). It is only read as
+    uploads finish, so it can be a generator still finding files
+    :arg workers: files uploaded at the same time
+    :returns UploadSummary
+    """
+    summary = UploadSummary()
+
+    def collect(futures):
+        for future in futures:
+            (local_file, key) = in_flight.pop(future)
+            try:
+                summary.add(future.result())
+                summary.sent.append((local_file, key))
+                logger.debug(f"Sent {local_file} to {key}")
+            except Exception as error:
+                logger.critical(f"Couldn't upload {local_file}: {error}")
+                summary.failed.append(local_file)
+
+    in_flight = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for (local_file, key) in uploads:
+            if len(in_flight) >= workers * 2:
+                (done, pending) = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(upload_file, s3simple, local_file, key, retries, backoff)
+            in_flight[future] = (local_file, key)
+        collect(list(concurrent.futures.as_completed(in_flight)))
+    summary.finish()
+    return summary
@@ -0,0 +1,106 @@
+"""
+Move objects in the log bucket with flat keys (RawLogFile_domain_date_name
+and so on, from before the bucket was partitioned) under the kind, domain
+and day prefixes of log_keys
+
+Objects are copied, the manifest of analyzed files is updated to the new
+keys, then the old objects are deleted. Running it again picks up where
+an interrupted run stopped.
+
+version 0.1
+"""
+import concurrent.futures
+import click
+import logging
+from system_utilities import get_configs
+from simple_AWS.s3_functions import *
+from log_keys import flat_key_partition
+from log_reporting_utilities import processed_log_rename
+
+logger = logging.getLogger('logger')
+
+# Most keys S3 deletes in one request
+DELETE_BATCH = 1000
+
+@click.command()
+@click.option('--dry_run', is_flag=True, default=False, help="Only list the objects that would be moved")
+@click.option('--keep', is_flag=True, default=False, help="Keep the objects under their old keys too")
+@click.option('--workers', type=int, default=8, help="Number of objects to copy at the same time. Default is 8")
+
+def migrate(dry_run, keep, workers):
+    configs = get_configs()
+    s3simple = S3Simple(region_name=configs['region'],
+                                profile=configs['profile'],
+                                bucket_name=configs['log_storage_bucket'])
+    client = s3simple.s3.meta.client
+    bucket_name = s3simple.bucket.name
+
+    logger.debug("Listing flat keys...")
+    moves = []
+    paginator = client.get_paginator('list_objects_v2')
+    # with a delimiter, objects already under prefixes aren't listed
+    for page in paginator.paginate(Bucket=bucket_name, Delimiter='/'):
+        for s3_object in page.get('Contents', []):
+            new_key = flat_key_partition(s3_object['Key'])
+            if not new_key:
+                logger.debug(f"Leaving {s3_object['Key']}")
+                continue
+            moves.append((s3_object['Key'], s3_object['ETag'].strip('"'), new_key))
+
+    if dry_run:
+        for (old_key, old_etag, new_key) in moves:
+            print(f"{old_key} -> {new_key}")
+        print(f"{len(moves)} objects to move")
+        return
+
+    def copy(old_key, new_key):
+        client.copy({'Bucket': bucket_name, 'Key': old_key}, bucket_name, new_key)
+        return client.head_object(Bucket=bucket_name, Key=new_key)['ETag'].strip('"')
+
+    renames = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(copy, old_key, new_key): (old_key, old_etag, new_key)
+                   for (old_key, old_etag, new_key) in moves}
+        for future in concurrent.futures.as_completed(futures):
+            (old_key, old_etag, new_key) = futures[future]
+            try:
+                renames[old_key] = (old_etag, new_key, future.result())
+                logger.debug(f"Copied {old_key} to {new_key}")
+            except Exception as error:
+                logger.critical(f"Couldn't copy {old_key}: {error}")
+
+    logger.debug("Updating analyzed files...")
+    processed_log_rename(renames)
+
+    if not keep:
+        logger.debug("Deleting old keys...")
+        old_keys = list(renames)
+        for start in range(0, len(old_keys), DELETE_BATCH):
+            batch = [{'Key': key} for key in old_keys[start:start + DELETE_BATCH]]
+            response = client.delete_objects(Bucket=bucket_name, Delete={'Objects': batch, 'Quiet': True})
+            for error in response.get('Errors', []):
+                logger.critical(f"Couldn't delete {error['Key']}: {error['Message']}")
+
+    logger.info(f"Moved {len(renames)} of {len(moves)} objects")
+
+    return
+
+if __name__ == '__main__':
+    configs = get_configs()
+    log = configs['log_level']
+    logger = logging.getLogger('logger')  # instantiate clogger
+    logger.setLevel(logging.DEBUG)  # pass DEBUG and higher values to handler
+
+    ch = logging.StreamHandler()  # use StreamHandler, which prints to stdout
+    ch.setLevel(configs['log_level'])  # ch handler uses the configura
+
+    # create formatter
+    # display the function name and logging level in columnar format if
+    # logging mode is 'DEBUG'
+    formatter = logging.Formatter('[%(funcName)24s] [%(levelname)8s] %(message)s')
+
+    # add formatter to ch
+    ch.setFormatter(formatter)
+    logger.addHandler(ch)
+
+    migrate()
@@ -2,86 +2,149 @@ import sys
 import os
 import datetime
 import time
+import fnmatch
 import click
-import sh
 import logging
 from system_utilities import get_configs
 from simple_AWS.s3_functions import *
+from log_uploads import upload_files, UploadState
+from log_keys import partitioned_key, RAW_LOG_KIND, KEY_DATE_FORMAT
 
 logger = logging.getLogger('logger')
 
+# Compressed (rotated) logs, only sent with --zip
+COMPRESSED_EXTENSIONS = {'gz', 'bz2'}
+
 @click.command()
 @click.option('--daemon', is_flag=True, default=False, help="Run in daemon mode. All output goes to a file.")
 @click.option('--zip', is_flag=True, help="Save zipped log files", default=False)
 @click.option('--recursive', is_flag=True, help="Descent through directories")
 @click.option('--range', type=int, help="Days of log file age to save. Default is 7", default=7)
+@click.option('--uploads', type=int, help="Number of files to upload at the same time. Default is 4", default=4)
+@click.option('--pattern', help="Pattern names of log files match. Default is *access*", default='*access*')
+@click.option('--force', is_flag=True, default=False, help="Upload files even if they were uploaded before")
 
-def move_logs(daemon, zip, recursive, range):
+def move_logs(daemon, zip, recursive, range, uploads, pattern, force):
     """
     Move logs from local to s3
     """
     configs = get_configs()
-    now = datetime.datetime.now()
-    now_string = now.strftime('%d-%b-%Y:%H:%M:%S')
 
     # TODO: Make this domain specific
     s3simple = S3Simple(region_name=configs['region'],
                         profile=configs['profile'],
                         bucket_name=configs['log_storage_bucket'])
     
+    state = UploadState(configs['upload_state'])
+
     logger.debug("Reading Local Files...")
+    paths = []
     if configs['paths']:
         # open paths file
         with open(configs['paths']) as pathfile:
             raw_path_list = pathfile.read()
-        paths = raw_path_list.split('\n')
+        for fpath in raw_path_list.split('\n'):
+            if not fpath:
+                continue
+            domain, path = fpath.split('|')
+            if not os.path.exists(path):
+                logger.critical("Path doesn't exist!")
+                return
+            paths.append((domain, path))
 
-    for fpath in paths:
-        if not fpath:
-            continue
-        domain, path = fpath.split('|')
-        if not os.path.exists(path):
-            logger.critical("Path doesn't exist!")
-            return
-        if not os.path.isdir(path):
-            files = [path]
-        else:
-            files = get_list(path, recursive, range)
+    hashed = {}
+    def to_send():
+        """
+        Files to upload, as they are found
+        """
+        for (domain, path) in paths:
+            logger.debug(f"Path: {path}")
+            skip_extensions = set() if zip else COMPRESSED_EXTENSIONS
+            if not os.path.isdir(path):
+                wanted = (fnmatch.fnmatch(os.path.basename(path), pattern) and
+                          log_file_wanted(path, os.stat(path).st_mtime, range=range, skip_extensions=skip_extensions))
+                files = [path] if wanted else []
+            else:
+                files = find_log_files(path, recursive=recursive, range=range, pattern=pattern,
+                                       skip_extensions=skip_extensions)
+            for file_name in files:
+                file_path = file_name.split('/')
+                just_file_name = '.'.join(file_path)
+                logger.debug(f"File Name {just_file_name}")
+                stat = os.stat(file_name)
+                (uploaded_key, sha256) = state.uploaded_key(file_name, stat)
+                if uploaded_key and not force:
+                    logger.debug(f"Already uploaded to {uploaded_key}")
+                    # a renamed copy is remembered under its new path too
+                    state.record(file_name, stat, sha256, uploaded_key)
+                    continue
+                # named by modification time, not upload time, so an unchanged
+                # file always gets the same key
+                modified = datetime.datetime.fromtimestamp(stat.st_mtime)
+                s3_file = partitioned_key(RAW_LOG_KIND, domain, modified, RAW_LOG_KIND + '_' + domain + '_' +
+                                          modified.strftime(KEY_DATE_FORMAT) + '_' + just_file_name)
+                hashed[file_name] = (stat, sha256)
+                yield (file_name, s3_file)
 
-        logger.debug(f"Path: {path}")
+    logger.debug("sending to s3...")
+    summary = upload_files(s3simple, to_send(), workers=uploads)
+    logger.info(str(summary))
+    for (file_name, s3_file) in summary.sent:
+        (stat, sha256) = hashed[file_name]
+        state.record(file_name, stat, sha256, s3_file)
+    state.save()
 
-        # send to S3
-        for file_name in files:
-            if 'access' not in file_name:
-                    continue
-            file_path = file_name.split('/')
-            file_parts = file_path[-1].split('.')
-            just_file_name = '.'.join(file_path)
-            logger.debug(f"File Name {just_file_name}")
-            ext = file_parts[-1]
-            if ((ext == 'bz2' or ext == 'gz')) and not zip:
-                continue 
-            logger.debug("sending to s3...")
-            s3_file =  'RawLogFile_' + domain + '_' + now_string + '_' + just_file_name
-            s3simple.send_file_to_s3(local_file=file_name, s3_file=s3_file)
+def find_log_files(path, recursive=False, range=7, pattern='*access*', skip_extensions=(), visited=None):
+    """
+    Walks a directory, yielding log files as they are found. Uses the
+    file type and stat os.scandir already has, so each file is only
+    looked at once
+    :arg path: directory
+    :arg recursive: descend into subdirectories
+    :arg range: days of log file age to include
+    :arg pattern: shell-style pattern file names must match
+    :arg skip_extensions: extensions of files to leave out
+    :arg visited: (st_dev, st_ino) of the directories already walked, so
+    symlinked directories are followed but a symlink loop isn't
+    :yields full path of each file
+    """
+    if visited is None:
+        visited = set()
+    try:
+        stat = os.stat(path)
+        entries = os.scandir(path)
+    except OSError as error:
+        logger.warning(f"Can't read {path}: {error}")
+        return
+    if (stat.st_dev, stat.st_ino) in visited:
+        entries.close()
+        logger.debug(f"Already walked {path}")
+        return
+    visited.add((stat.st_dev, stat.st_ino))
+    with entries:
+        for entry in entries:
+            if entry.is_dir():
+                if recursive:
+                    yield from find_log_files(entry.path, recursive, range, pattern, skip_extensions, visited)
+                continue
+            # names are matched before stat, which takes a system call
+            if not entry.is_file() or not fnmatch.fnmatch(entry.name, pattern):
+                continue
+            if log_file_wanted(entry.path, entry.stat().st_mtime, range, skip_extensions):
+                yield entry.path
 
-def get_list(path, recursive, range):
-    now = datetime.datetime.now()
-    file_list = os.listdir(path)
-    all_files = []
-    for entry in file_list:
-        full_path = os.path.join(path, entry)
-        # How old is the file?
-        modified = datetime.datetime.fromtimestamp(os.path.getmtime(full_path))
-        numdays = (now - modified).days
-        logger.debug(f"File: {full_path} Age: {numdays}")
-        if numdays > range:
-            continue
-        if os.path.isdir(full_path) and recursive:
-            all_files = all_files + get_list(full_path, recursive)
-        else:
-            all_files.append(full_path)
-    return all_files
+def log_file_wanted(file_name, modified, range=7, skip_extensions=()):
+    """
+    Whether a log file whose name matches the pattern is one to send
+    :arg file_name: path of the file
+    :arg modified: its modification time, from stat
+    :arg range, skip_extensions: as for find_log_files
+    """
+    if file_name.split('.')[-1] in skip_extensions:
+        return False
+    # How old is the file?
+    logger.debug(f"File: {file_name} Age: {int((time.time() - modified) // 86400)}")
+    return modified >= time.time() - (range + 1) * 86400
 
 if __name__ == '__main__':
     configs = get_configs()
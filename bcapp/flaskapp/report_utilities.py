@@ -1,39 +1,32 @@
 import datetime
 import logging
-import os
 import re
 import socket
 import json
 import datetime
-from dotenv import load_dotenv
 import sqlalchemy as db
 from system_utilities import get_configs, send_email
+from db_utilities import get_table, connect
 
 logger = logging.getLogger('logger')
 
 def lists():
 
-    load_dotenv()
-    engine = db.create_engine(os.environ['DATABASE_URL'])
-    connection = engine.connect()
-    metadata = db.MetaData()
-
-    domains = db.Table('domains', metadata, autoload=True, autoload_with=engine)
-    mirrors = db.Table('mirrors', metadata, autoload=True, autoload_with=engine)
+    domains = get_table('domains')
+    mirrors = get_table('mirrors')
 
     # First, get domains and mirrors for matching
 
-    domains_list = []
-    query = db.select([domains])
-    result = connection.execute(query).fetchall()
+    with connect() as connection:
+        domain_result = connection.execute(db.select([domains])).fetchall()
+        mirror_result = connection.execute(db.select([mirrors])).fetchall()
 
-    for line in result:
+    domains_list = []
+    for line in domain_result:
         domains_list.append({'id' : line[0], 'name' : line[1]})
 
     mirrors_list = []
-    query = db.select([mirrors])
-    result = connection.execute(query).fetchall()
-    for line in result:
+    for line in mirror_result:
         mirrors_list.append({'id' : line[0], 'mirror_url' : line[1], 'domain_id' : line[2]})
  
     return (domains_list, mirrors_list)
@@ -45,13 +38,10 @@ def reports(domain_id):
     :returns: all reports for a domain
     """
     # Get reports:
-    engine = db.create_engine(os.environ['DATABASE_URL'])
-    connection = engine.connect()
-    metadata = db.MetaData()
-
-    reports = db.Table('reports', metadata, autoload=True, autoload_with=engine)
+    reports = get_table('reports')
     query = db.select([reports]).where(reports.c.domain_id==domain_id)
-    result = connection.execute(query).fetchall()
+    with connect() as connection:
+        result = connection.execute(query).fetchall()
 
     print(result)
 
@@ -87,17 +77,13 @@ def translate_reports(report):
     """
     Translates report from postgres into text for display or email
     """
-    load_dotenv()
-    engine = db.create_engine(os.environ['DATABASE_URL'])
-    connection = engine.connect()
-    metadata = db.MetaData()
-
-    domains = db.Table('domains', metadata, autoload=True, autoload_with=engine)
-    mirrors = db.Table('mirrors', metadata, autoload=True, autoload_with=engine)
-    domain_query = db.select([domains])
-    domain_list = connection.execute(domain_query).fetchall()
-    mirror_query = db.select([mirrors])
-    mirror_list = connection.execute(mirror_query).fetchall()
+    domains = get_table('domains')
+    mirrors = get_table('mirrors')
+    with connect() as connection:
+        domain_query = db.select([domains])
+        domain_list = connection.execute(domain_query).fetchall()
+        mirror_query = db.select([mirrors])
+        mirror_list = connection.execute(mirror_query).fetchall()
 
     translated_report = f"Date Reported: {report['date_reported']} \n"
     translated_report += f"User Agent: {report['user_agent']} \n"
@@ -119,14 +105,10 @@ def generate_admin_report(mode):
     yesterday = datetime.datetime.today() - datetime.timedelta(days=1)
     configs = get_configs()
 
-    load_dotenv()
-    engine = db.create_engine(os.environ['DATABASE_URL'])
-    connection = engine.connect()
-    metadata = db.MetaData()
-
-    reports = db.Table('reports', metadata, autoload=True, autoload_with=engine)
+    reports = get_table('reports')
     report_query = db.select([reports]).where(reports.c.date_reported > yesterday)
-    report_list = connection.execute(report_query).fetchall()
+    with connect() as connection:
+        report_list = connection.execute(report_query).fetchall()
 
     important_reports = ""
     for report in report_list:
@@ -144,9 +126,10 @@ def generate_admin_report(mode):
         else:
             message_to_send = "No Problematic Domains or Alternatives for the day. Check system."
 
-        users = db.Table('users', metadata, autoload=True, autoload_with=engine)
+        users = get_table('users')
         user_query = db.select([users]).where(users.c.admin == True)
-        user_list = connection.execute(user_query).fetchall()
+        with connect() as connection:
+            user_list = connection.execute(user_query).fetchall()
         for user in user_list:
             email = send_email(
                         user['email'],
@@ -182,68 +165,63 @@ def send_report(domain_data, mode):
     host_name = socket.gethostname()
     host_ip = socket.gethostbyname(host_name) 
 
-    configs = get_configs()
+    domains = get_table('domains')
+    mirrors = get_table('mirrors')
+    reports = get_table('reports')
 
-    engine = db.create_engine(configs['database_url'])
-    connection = engine.connect()
-    metadata = db.MetaData()
+    with connect() as connection:
+        query = db.select([domains])
+        result = connection.execute(query).fetchall()
 
-    domains = db.Table('domains', metadata, autoload=True, autoload_with=engine)
-    mirrors = db.Table('mirrors', metadata, autoload=True, autoload_with=engine)
-    reports = db.Table('reports', metadata, autoload=True, autoload_with=engine)
+        domain_id = False
+        for entry in result:
+            d_id, domain, ext, paths = entry
+            if domain in domain_data['domain']:
+                domain_id = d_id
 
-    query = db.select([domains])
-    result = connection.execute(query).fetchall()
-    
-    domain_id = False
-    for entry in result:
-        d_id, domain, ext, paths = entry
-        if domain in domain_data['domain']:
-            domain_id = d_id
-    
-    logger.debug(f"Domain ID: {domain_id}")
-    
-    if not domain_id: # we've not seen it before, add it
-        insert = domains.insert().values(domain=domain_data['domain'])
-        result = connection.execute(insert)
-        domain_id = result.inserted_primary_key[0]
         logger.debug(f"Domain ID: {domain_id}")
-    
-    # Add mirrors
-    if (('current_alternatives' not in domain_data) or (not domain_data['current_alternatives'])):
-        return False
-    for current_alternative in domain_data['current_alternatives']:
-        query = db.select([mirrors])
-        result = connection.execute(query).fetchall()
-        mirror_id = False
-        for entry in result:
-            m_id, m_url, d_id, proto, m_type = entry
-            if current_alternative['url'] == m_url:
-                mirror_id = m_id
-        logger.debug(f"Mirror ID: {mirror_id}")
-
-        if not mirror_id: # add it
-            insert = mirrors.insert().values(
-                mirror_url=current_alternative['url'],
-                domain_id=domain_id,
-                mirror_type=current_alternative['type'],
-                proto=current_alternative['proto'])
-            result = connection.execute(insert)
-            mirror_id = result.inserted_primary_key[0]
 
+        if not domain_id: # we've not seen it before, add it
+            insert = domains.insert().values(domain=domain_data['domain'])
+            result = connection.execute(insert)
+            domain_id = result.inserted_primary_key[0]
+            logger.debug(f"Domain ID: {domain_id}")
+
+        # Add mirrors
+        if (('current_alternatives' not in domain_data) or (not domain_data['current_alternatives'])):
+            return False
+        for current_alternative in domain_data['current_alternatives']:
+            query = db.select([mirrors])
+            result = connection.execute(query).fetchall()
+            mirror_id = False
+            for entry in result:
+                m_id, m_url, d_id, proto, m_type = entry
+                if current_alternative['url'] == m_url:
+                    mirror_id = m_id
             logger.debug(f"Mirror ID: {mirror_id}")
-        
-        # Make report
-        report_data = {
-            'date_reported': now,
-            'domain_id': domain_id,
-            'mirror_id': mirror_id,
-            'user_agent': f'BC APP {mode}',
-            'domain_status': domain_data[domain_data['domain']],
-            'mirror_status': current_alternative['result'],
-            'ip': host_ip
-        }
-        insert = reports.insert().values(**report_data)
-        result = connection.execute(insert)
-
-    return True
\ No newline at end of file
+
+            if not mirror_id: # add it
+                insert = mirrors.insert().values(
+                    mirror_url=current_alternative['url'],
+                    domain_id=domain_id,
+                    mirror_type=current_alternative['type'],
+                    proto=current_alternative['proto'])
+                result = connection.execute(insert)
+                mirror_id = result.inserted_primary_key[0]
+
+                logger.debug(f"Mirror ID: {mirror_id}")
+
+            # Make report
+            report_data = {
+                'date_reported': now,
+                'domain_id': domain_id,
+                'mirror_id': mirror_id,
+                'user_agent': f'BC APP {mode}',
+                'domain_status': domain_data[domain_data['domain']],
+                'mirror_status': current_alternative['result'],
+                'ip': host_ip
+            }
+            insert = reports.insert().values(**report_data)
+            result = connection.execute(insert)
+
+        return True
@@ -2,6 +2,7 @@ import smtplib
 from email.mime.text import MIMEText
 import configparser
 import os
+import json
 import logging
 
 logger = logging.getLogger('logger')
@@ -34,6 +35,8 @@ def get_configs():
         'security_group': config.get('AWS', 'security_group'),
         'paths': config.get('LOGS', 'path_file'),
         'log_storage_bucket': config.get('LOGS', 'log_storage_bucket'),
+        'upload_state': config.get('LOGS', 'upload_state', fallback='move_logs_state.json'),
+        'agent_state': config.get('LOGS', 'agent_state', fallback='log_agent_state.json'),
         'log_level': config.get('SYSTEM', 'log_level'),
         'local_tmp': config.get('SYSTEM', 'local_tmp'),
         'database_url': config.get('DATABASE', 'url'),
@@ -47,6 +50,33 @@ def get_configs():
 
     return configs
 
+def load_state(file_name):
+    """
+    Reads a JSON file a tool keeps its state in between runs
+    :arg file_name
+    :returns the state, or {} if there is none yet or it can't be read
+    """
+    if not os.path.exists(file_name):
+        return {}
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except ValueError:
+        logger.warning(f"State file {file_name} is unreadable, starting again")
+        return {}
+
+def save_state(file_name, state):
+    """
+    Writes the state of a tool to a JSON file. Written to a temporary
+    file first, so an interrupted run can't leave it half written
+    :arg file_name
+    :arg state: JSON-compatible dict
+    """
+    temporary = file_name + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary, file_name)
+
 def send_email(recipient, subject, message):
 
     configs = get_configs()
@@ -0,0 +1,89 @@
+"""
+Classification of user agent strings: crawlers and other bots, browser
+family, mobile and Tor Browser
+
+Logs repeat the same few thousand user agents over and over, so
+results are cached by user agent string and the rules only run once
+for each.
+"""
+import re
+import functools
+import collections
+
+UserAgentClass = collections.namedtuple('UserAgentClass', [
+    'name',     # label reports are grouped by
+    'family',   # browser family or bot name
+    'bot',
+    'mobile',
+    'tor'
+])
+
+# Crawlers and tools, by the name they go by in their user agent
+_KNOWN_BOTS = re.compile(
+    r'(Googlebot|AdsBot-Google|Mediapartners-Google|bingbot|BingPreview|YandexBot|Baiduspider|DuckDuckBot|'
+    r'Applebot|Slurp|AhrefsBot|SemrushBot|MJ12bot|DotBot|PetalBot|Bytespider|GPTBot|CCBot|'
+    r'facebookexternalhit|Twitterbot|LinkedInBot|Slackbot|TelegramBot|WhatsApp|Discordbot|'
+    r'python-requests|python-urllib|aiohttp|curl|Wget|Go-http-client|okhttp|Java|libwww-perl|'
+    r'Scrapy|HeadlessChrome|PhantomJS|UptimeRobot|Pingdom)',
+    re.IGNORECASE
+)
+
+# Anything else that says what it is
+_GENERIC_BOT = re.compile(r'bot\b|crawl|spider|scrape|scan|monitor|fetch|preview|http-?client', re.IGNORECASE)
+
+# Tor Browser reports the Firefox ESR it is built on, as if on Windows
+# (or Android), without the platform details regular Firefox sends. On
+# desktop that shape is enough, as Firefox on 64-bit Windows adds
+# "Win64; x64" or "WOW64", whatever the version
+_TOR_BROWSER = re.compile(
+    r'Mozilla/5\.0 \(Windows NT 10\.0; rv:(\d+)\.0\) Gecko/20100101 Firefox/\1\.0$'
+)
+# Regular Firefox for Android sends the same user agent as Tor Browser
+# for Android, which can only be told apart by being on an ESR version
+_TOR_BROWSER_MOBILE = re.compile(r'Mozilla/5\.0 \(Android \d+; Mobile; rv:(\d+)\.0\) Gecko/\1\.0 Firefox/\1\.0$')
+# Firefox ESR versions, for Tor Browser for Android. Add each new ESR
+# when it ships (about once a year)
+FIREFOX_ESR = {'52', '60', '68', '78', '91', '102', '115', '128', '140'}
+
+_MOBILE = re.compile(r'Mobi|Android|iPhone|iPad|iPod|Windows Phone', re.IGNORECASE)
+
+# Checked in order, as most browsers also claim to be the ones before them
+_BROWSER_FAMILIES = [
+    ('Edge', re.compile(r'Edge?/|EdgA/|EdgiOS/')),
+    ('Opera', re.compile(r'OPR/|Opera')),
+    ('Samsung Internet', re.compile(r'SamsungBrowser/')),
+    ('Yandex Browser', re.compile(r'YaBrowser/')),
+    ('UC Browser', re.compile(r'UCBrowser/')),
+    ('Chrome', re.compile(r'Chrome/|CriOS/|Chromium/')),
+    ('Firefox', re.compile(r'Firefox/|FxiOS/')),
+    ('Safari', re.compile(r'Version/[\d.]+.*Safari/')),
+    ('Internet Explorer', re.compile(r'MSIE |Trident/'))
+]
+
+@functools.lru_cache(maxsize=8192)
+def classify_user_agent(user_agent):
+    """
+    Classifies a user agent string
+    :arg user_agent
+    :returns UserAgentClass
+    """
+    if not user_agent or user_agent == '-':
+        return UserAgentClass('Bot: no user agent', 'no user agent', True, False, False)
+
+    bot = _KNOWN_BOTS.search(user_agent)
+    if bot:
+        return UserAgentClass('Bot: ' + bot.group(1), bot.group(1), True, False, False)
+    if _GENERIC_BOT.search(user_agent):
+        return UserAgentClass('Bot: other', 'other', True, False, False)
+
+    mobile = _MOBILE.search(user_agent) is not None
+    tor_mobile = _TOR_BROWSER_MOBILE.match(user_agent)
+    if _TOR_BROWSER.match(user_agent) or (tor_mobile and tor_mobile.group(1) in FIREFOX_ESR):
+        return UserAgentClass('Tor Browser (mobile)' if mobile else 'Tor Browser', 'Tor Browser', False, mobile, True)
+
+    family = 'Other'
+    for (name, rule) in _BROWSER_FAMILIES:
+        if rule.search(user_agent):
+            family = name
+            break
+    return UserAgentClass(family + ' (mobile)' if mobile else family, family, False, mobile, False)